@@ -0,0 +1,113 @@
+# access_log.py
+"""
+Access log strutturato (JSON lines), un record per richiesta.
+
+I record passano da un QueueHandler a un QueueListener su thread separato:
+il thread della richiesta fa solo una put_nowait in coda, mai I/O su stdout.
+Se la coda è piena il record viene scartato (e contato), non si blocca.
+
+Uso nelle view:
+    access_log.begin(route="natal")        # inizio richiesta
+    with access_log.stage("geocode"): ...  # durata di una fase (ms)
+    access_log.annotate(cache="hit")       # campi liberi
+Il record viene emesso da emit() nell'after_request.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from flask import g, has_request_context
+
+ACCESS_LOG = os.getenv("ACCESS_LOG", "1") == "1"
+# frazione dei record "di successo" (status < 400 e non lenti) effettivamente scritti
+ACCESS_LOG_SUCCESS_SAMPLE = float(os.getenv("ACCESS_LOG_SUCCESS_SAMPLE", "1.0"))
+ACCESS_LOG_SLOW_MS = float(os.getenv("ACCESS_LOG_SLOW_MS", "1000"))  # sopra: sempre loggato
+ACCESS_LOG_QUEUE_SIZE = int(os.getenv("ACCESS_LOG_QUEUE_SIZE", "10000"))
+
+STATS = {"emitted": 0, "sampled_out": 0, "dropped": 0}
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler che scarta il record a coda piena invece di bloccare/sollevare."""
+
+    def prepare(self, record):
+        return record   # la serializzazione JSON avviene nel thread del listener
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            STATS["dropped"] += 1
+
+class _JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, separators=(",", ":"), default=str)
+
+_queue = queue.Queue(maxsize=ACCESS_LOG_QUEUE_SIZE)
+_stream = logging.StreamHandler(sys.stdout)
+_stream.setFormatter(_JsonLineFormatter())
+_listener = logging.handlers.QueueListener(_queue, _stream, respect_handler_level=False)
+
+logger = logging.getLogger("astrocalc.access")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if ACCESS_LOG:
+    logger.addHandler(_DroppingQueueHandler(_queue))
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def begin(**fields):
+    """Apre il record della richiesta corrente."""
+    g.access = {"t0": time.perf_counter(), "stages": {}, **fields}
+
+def _current():
+    return g.get("access") if has_request_context() else None
+
+def annotate(**fields):
+    rec = _current()
+    if rec is not None:
+        rec.update(fields)
+
+@contextmanager
+def stage(name):
+    """Misura una fase in ms nel record corrente (no-op fuori da una richiesta tracciata)."""
+    rec = _current()
+    if rec is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        rec["stages"][name] = round((time.perf_counter() - t0) * 1000, 2)
+
+def emit(resp):
+    """Chiude e accoda il record (se la richiesta ne ha uno), con campionamento dei successi."""
+    rec = _current()
+    if rec is None or not ACCESS_LOG:
+        return resp
+    g.access = None
+    duration_ms = round((time.perf_counter() - rec.pop("t0")) * 1000, 2)
+    status = resp.status_code
+    if (status < 400 and duration_ms < ACCESS_LOG_SLOW_MS
+            and ACCESS_LOG_SUCCESS_SAMPLE < 1.0 and random.random() >= ACCESS_LOG_SUCCESS_SAMPLE):
+        STATS["sampled_out"] += 1
+        return resp
+    record = {
+        "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "status": status,
+        "duration_ms": duration_ms,
+        **rec,
+    }
+    if ACCESS_LOG_SUCCESS_SAMPLE < 1.0:
+        record["sample_rate"] = ACCESS_LOG_SUCCESS_SAMPLE
+    logger.info(record)
+    STATS["emitted"] += 1
+    return resp
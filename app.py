@@ -1,20 +1,32 @@
 import os
-from http_utils import http_get, http_post
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
-from threading import BoundedSemaphore
+from http_utils import (
+    http_get, http_post, TokenBucket, retry_after_seconds,
+    DeadlineExceeded, deadline_scope, remaining, http_stats,
+)
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, request, jsonify, stream_with_context
+from threading import BoundedSemaphore, Event, Lock
 # from geopy.geocoders import Nominatim
 from timezonefinder import TimezoneFinder
 import pytz
 import swisseph as swe
-import sys, time, random, json, requests
+import sys, time, random, json, requests, re, unicodedata, gzip, tempfile
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson   # opzionale: serializzazione JSON molto più veloce
+except ImportError:
+    orjson = None
+import numpy as np
 from typing import Optional, Dict, Any, Tuple
 # --- TimezoneFinder cache ---
 from cachetools import TTLCache
 # from requests.adapters import HTTPAdapter # <- non usato qui
 # from urllib3.util.retry import Retry # <- non usato qui
 # --- Timezone utilities (in alto, vicino ad altri global) ---
-from pytz import AmbiguousTimeError, NonExistentTimeError
+from tz_offsets import local_to_utc, utc_offsets_many
+from tz_grid import get_grid
+import profiling
+import access_log
 # --- Per test, contatori e contatore di utilizzo api (Incluso Google)
 from collections import Counter
 from datetime import date
@@ -56,18 +68,52 @@ def _bump(field: str, n: int = 1):
 GEOCODE_PROVIDER_COUNTS = Counter()
 LAST_GEOCODE_HIT = {"source": None, "name": None, "lat": None, "lon": None}
 
-TF = TimezoneFinder()
 TZ_CACHE = TTLCache(maxsize=5000, ttl=30*24*3600)  # cache 30 giorni
+TZ_LOOKUP_STATS = Counter()
+
+# TimezoneFinder caricato solo al primo uso: con la griglia serve solo per le celle di confine
+_TF = None
+
+def _timezone_finder() -> TimezoneFinder:
+    global _TF
+    if _TF is None:
+        _TF = TimezoneFinder()
+    return _TF
+
+def _tf_lookup(lat: float, lon: float) -> Optional[str]:
+    TZ_LOOKUP_STATS["finder"] += 1
+    tf = _timezone_finder()
+    return tf.timezone_at(lng=lon, lat=lat) or tf.closest_timezone_at(lng=lon, lat=lat)
+
+# Policy per orari ambigui/inesistenti nei cambi d'ora (vedi tz_offsets)
+TZ_AMBIGUOUS_POLICY = os.getenv("TZ_AMBIGUOUS_POLICY", "earlier")
+TZ_NONEXISTENT_POLICY = os.getenv("TZ_NONEXISTENT_POLICY", "shift_forward")
 
 def resolve_timezone(lat: float, lon: float) -> str:
     key = (round(lat, 4), round(lon, 4))
     hit = TZ_CACHE.get(key)
     if hit: return hit
-    tzname = TF.timezone_at(lng=lon, lat=lat) or TF.closest_timezone_at(lng=lon, lat=lat)
+    # griglia precalcolata (tz_grid.py): O(1) per le celle interne
+    grid = get_grid()
+    tzname = grid.lookup(lat, lon) if grid is not None else None
+    if tzname:
+        TZ_LOOKUP_STATS["grid"] += 1
+    else:
+        tzname = _tf_lookup(lat, lon)
     if tzname:
         TZ_CACHE[key] = tzname
     return tzname
 
+def resolve_timezones(lats, lons) -> list:
+    """Versione batch: griglia vettoriale su tutte le coordinate, TimezoneFinder solo sui confini."""
+    grid = get_grid()
+    names = list(grid.lookup_many(lats, lons)) if grid is not None else [None] * len(lats)
+    TZ_LOOKUP_STATS["grid"] += sum(1 for n in names if n)
+    for i, n in enumerate(names):
+        if not n:
+            names[i] = resolve_timezone(float(lats[i]), float(lons[i]))
+    return names
+
 # --- CONFIG GEOCODING ---
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY", "").strip() # opzionale
 GEOCODER_UA = os.getenv("GEOCODER_UA", "house-of-venus-astrocalc/1.0")
@@ -90,17 +136,150 @@ NOMINATIM_HEADERS = {
 def _norm_place(p: str) -> str:
     return " ".join(p.strip().split()).lower()
 
+# --- Indice alias dei luoghi ---
+# "Roma", "Rome, Italy", "rome IT", "Roma, Lazio" sono chiavi diverse per GEOCODE_CACHE.
+# Ogni risoluzione riuscita registra qui più forme normalizzate (query, forma a token
+# senza accenti/punteggiatura con i paesi ridotti al codice ISO, nome canonico del
+# provider) che puntano allo stesso risultato: le varianti successive restano locali.
+ALIAS_INDEX = TTLCache(maxsize=10000, ttl=24*3600)
+ALIAS_STATS = Counter()
+
+# varianti comuni del nome del paese -> codice ISO 3166-1 alpha-2
+COUNTRY_ALIASES = {
+    "it": "it", "italy": "it", "italia": "it", "ita": "it",
+    "pl": "pl", "poland": "pl", "polska": "pl", "pol": "pl",
+    "de": "de", "germany": "de", "deutschland": "de", "deu": "de",
+    "fr": "fr", "france": "fr", "fra": "fr",
+    "es": "es", "spain": "es", "espana": "es", "esp": "es",
+    "pt": "pt", "portugal": "pt", "prt": "pt",
+    "gb": "gb", "uk": "gb", "united kingdom": "gb", "great britain": "gb", "gbr": "gb",
+    "us": "us", "usa": "us", "united states": "us", "united states of america": "us",
+    "ch": "ch", "switzerland": "ch", "schweiz": "ch", "suisse": "ch", "svizzera": "ch",
+    "at": "at", "austria": "at", "osterreich": "at",
+    "nl": "nl", "netherlands": "nl", "nederland": "nl", "the netherlands": "nl", "holland": "nl",
+    "be": "be", "belgium": "be", "belgique": "be", "belgie": "be",
+    "gr": "gr", "greece": "gr", "hellas": "gr",
+    "ie": "ie", "ireland": "ie", "eire": "ie",
+    "cz": "cz", "czechia": "cz", "czech republic": "cz", "cesko": "cz",
+    "ua": "ua", "ukraine": "ua", "ukraina": "ua",
+    "ru": "ru", "russia": "ru", "russian federation": "ru", "rossiya": "ru",
+    "br": "br", "brazil": "br", "brasil": "br",
+    "mx": "mx", "mexico": "mx",
+    "ar": "ar", "argentina": "ar",
+    "ca": "ca", "canada": "ca",
+    "au": "au", "australia": "au",
+    "jp": "jp", "japan": "jp", "nippon": "jp",
+    "cn": "cn", "china": "cn",
+    "tr": "tr", "turkey": "tr", "turkiye": "tr",
+}
+
+def _fold_text(p: str) -> str:
+    """Minuscolo, senza accenti e punteggiatura (le virgole restano come separatori)."""
+    p = unicodedata.normalize("NFKD", p)
+    p = "".join(ch for ch in p if not unicodedata.combining(ch)).lower()
+    p = re.sub(r"[^\w,]+", " ", p)
+    return p
+
+def _fold_component(c: str) -> str:
+    c = " ".join(c.split())
+    return COUNTRY_ALIASES.get(c, c)
+
+def _alias_keys(text: str) -> list:
+    """
+    Chiavi alias di un testo di luogo:
+      t:<token ordinati>          forma a token (ordine e ripetizioni ignorati)
+      p:<località>|<c1>|<c2>...   località + TUTTE le altre parti (ordinate)
+    Ogni chiave copre l'intera query: una chiave per singola parte confonderebbe
+    luoghi omonimi ("Springfield, Illinois, US" e "Springfield, Massachusetts, US").
+    """
+    parts = [_fold_component(c) for c in _fold_text(text).split(",")]
+    parts = [c for c in parts if c]
+    if not parts:
+        return []
+    # "rome it" / "rome italy" senza virgole: separa il paese finale dalla località
+    if len(parts) == 1:
+        toks = parts[0].split()
+        for n in (3, 2, 1):
+            if len(toks) > n and " ".join(toks[-n:]) in COUNTRY_ALIASES:
+                parts = [" ".join(toks[:-n]), COUNTRY_ALIASES[" ".join(toks[-n:])]]
+                break
+    tokens = sorted(set(" ".join(parts).split()))
+    keys = ["t:" + " ".join(tokens)]
+    locality = parts[0]
+    others = sorted({c for c in parts[1:] if c != locality})
+    if others:
+        keys.append("p:" + "|".join([locality] + others))
+    return keys
+
+def _alias_lookup(place: str) -> Optional[Dict[str, Any]]:
+    for k in _alias_keys(place):
+        hit = ALIAS_INDEX.get(k)
+        if hit:
+            return hit
+    return None
+
+def _alias_learn(place: str, res: Dict[str, Any]):
+    """Registra query grezza e nome canonico del provider (solo chiavi complete) come alias."""
+    keys = set(_alias_keys(place))
+    if res.get("name"):
+        keys.update(_alias_keys(res["name"]))
+    for k in keys:
+        ALIAS_INDEX[k] = res
+    ALIAS_STATS["learned_keys"] += len(keys)
+
+# --- Rate limit per provider (token bucket) ---
+# Formato: "provider=rate:burst,..." (rate in richieste/secondo). Nominatim e maps.co
+# chiedono max ~1 req/s. Se il bucket è vuoto si attende al più GEOCODER_RATE_WAIT
+# secondi, poi si passa al provider successivo invece di accumulare 429 e retry.
+GEOCODER_RATE_LIMITS = os.getenv(
+    "GEOCODER_RATE_LIMITS", "nominatim=1:1,mapsco=1:1,openmeteo=10:5,google=50:10"
+)
+GEOCODER_RATE_WAIT = float(os.getenv("GEOCODER_RATE_WAIT", "0.5"))
+# attesa massima di chi si accoda a una ricerca già in corso per lo stesso luogo
+GEOCODE_MERGE_WAIT = float(os.getenv("GEOCODE_MERGE_WAIT", "15"))
+
+def _parse_rate_limits(raw: str) -> Dict[str, TokenBucket]:
+    limiters = {}
+    for part in raw.split(","):
+        if "=" not in part:
+            continue
+        name, spec = part.split("=", 1)
+        rate, _, burst = spec.partition(":")
+        try:
+            limiters[name.strip().lower()] = TokenBucket(float(rate), float(burst or 1))
+        except ValueError:
+            continue
+    return limiters
+
+RATE_LIMITERS = _parse_rate_limits(GEOCODER_RATE_LIMITS)
+
+def _provider_get(provider: str, url: str, **kw):
+    """
+    http_get per i geocoder: se il provider ha un limiter, nessun retry (fail fast:
+    un token = una richiesta) e su 429 il bucket viene bloccato per il Retry-After.
+    """
+    limiter = RATE_LIMITERS.get(provider)
+    r = http_get(url, fail_fast=limiter is not None, **kw)
+    if limiter is not None and r.status_code == 429:
+        limiter.penalize(retry_after_seconds(r))
+    return r
+
+# ricerche in corso per chiave normalizzata: le richieste duplicate attendono la prima
+_INFLIGHT: Dict[str, Event] = {}
+_INFLIGHT_LOCK = Lock()
+GEOCODE_QUEUE_STATS = Counter()
+
+# Ogni provider è una coppia (richiesta, parsing): la versione sync qui sotto e quella
+# async (asgi.py) condividono URL, parametri e lettura della risposta.
 # --- Provider: Google ---
-def geocode_google(place: str) -> Optional[Dict[str, Any]]:
+def _google_request(place: str):
     if not GOOGLE_MAPS_API_KEY:
         return None
-    r = http_get(
-        "https://maps.googleapis.com/maps/api/geocode/json",
-        params={"address": place, "key": GOOGLE_MAPS_API_KEY}
-    )
-    if r.status_code != 200:
-        return None
-    data = r.json()
+    return "https://maps.googleapis.com/maps/api/geocode/json", {
+        "params": {"address": place, "key": GOOGLE_MAPS_API_KEY}
+    }
+
+def _google_parse(data, place: str) -> Optional[Dict[str, Any]]:
     if data.get("status") == "OK" and data.get("results"):
         it = data["results"][0]
         loc = it["geometry"]["location"]
@@ -111,15 +290,13 @@ def geocode_google(place: str) -> Optional[Dict[str, Any]]:
     return None
 
 # --- Provider: Nominatim (OpenStreetMap) ---
-def geocode_nominatim(place: str) -> Optional[Dict[str, Any]]:
-    r = http_get(
-        "https://nominatim.openstreetmap.org/search",
-        params={"q": place, "format": "json", "limit": 1, "addressdetails": 1},
-        headers=NOMINATIM_HEADERS,
-    )
-    if r.status_code != 200:
-        return None
-    js = r.json()
+def _nominatim_request(place: str):
+    return "https://nominatim.openstreetmap.org/search", {
+        "params": {"q": place, "format": "json", "limit": 1, "addressdetails": 1},
+        "headers": NOMINATIM_HEADERS,
+    }
+
+def _nominatim_parse(js, place: str) -> Optional[Dict[str, Any]]:
     if isinstance(js, list) and js:
         it = js[0]
         return {
@@ -129,14 +306,12 @@ def geocode_nominatim(place: str) -> Optional[Dict[str, Any]]:
     return None
 
 # --- Provider: Open-Meteo Geocoding ---
-def geocode_openmeteo(place: str) -> Optional[Dict[str, Any]]:
-    r = http_get(
-        "https://geocoding-api.open-meteo.com/v1/search",
-        params={"name": place, "count": 1, "language": "en", "format": "json"}
-    )
-    if r.status_code != 200:
-        return None
-    data = r.json()
+def _openmeteo_request(place: str):
+    return "https://geocoding-api.open-meteo.com/v1/search", {
+        "params": {"name": place, "count": 1, "language": "en", "format": "json"}
+    }
+
+def _openmeteo_parse(data, place: str) -> Optional[Dict[str, Any]]:
     res = data.get("results") or []
     if res:
         it = res[0]
@@ -150,11 +325,10 @@ def geocode_openmeteo(place: str) -> Optional[Dict[str, Any]]:
     return None
 
 # --- Provider: Maps.co (free wrapper OSM) ---
-def geocode_mapsco(place: str) -> Optional[Dict[str, Any]]:
-    r = http_get("https://geocode.maps.co/search", params={"q": place})
-    if r.status_code != 200:
-        return None
-    data = r.json()
+def _mapsco_request(place: str):
+    return "https://geocode.maps.co/search", {"params": {"q": place}}
+
+def _mapsco_parse(data, place: str) -> Optional[Dict[str, Any]]:
     if isinstance(data, list) and data:
         it = data[0]
         return {
@@ -163,7 +337,39 @@ def geocode_mapsco(place: str) -> Optional[Dict[str, Any]]:
         }
     return None
 
+GEOCODER_SPECS = {
+    "google": (_google_request, _google_parse),
+    "nominatim": (_nominatim_request, _nominatim_parse),
+    "openmeteo": (_openmeteo_request, _openmeteo_parse),
+    "mapsco": (_mapsco_request, _mapsco_parse),
+}
+
+def _run_provider(name: str, place: str) -> Optional[Dict[str, Any]]:
+    build, parse = GEOCODER_SPECS[name]
+    req = build(place)
+    if req is None:
+        return None
+    url, kw = req
+    r = _provider_get(name, url, **kw)
+    if r.status_code != 200:
+        return None
+    return parse(r.json(), place)
+
+def geocode_google(place: str) -> Optional[Dict[str, Any]]:
+    return _run_provider("google", place)
+
+def geocode_nominatim(place: str) -> Optional[Dict[str, Any]]:
+    return _run_provider("nominatim", place)
+
+def geocode_openmeteo(place: str) -> Optional[Dict[str, Any]]:
+    return _run_provider("openmeteo", place)
+
+def geocode_mapsco(place: str) -> Optional[Dict[str, Any]]:
+    return _run_provider("mapsco", place)
+
 # --- Geocoder order via ENV, con validazione e fallback ---
+_LAST_GEOCODER_ORDER: list = []
+
 def get_geocoder_order():
     """
     Costruisce la lista di provider nell'ordine richiesto.
@@ -197,10 +403,11 @@ def get_geocoder_order():
         default_order = ["google", "nominatim", "openmeteo", "mapsco"]
         providers = [allowed[n] for n in default_order if allowed[n]]
 
-    try:
-        app.logger.info(f"[geocode] ordine effettivo: {[fn.__name__ for fn in providers]}")
-    except Exception:
-        pass
+    # logga solo quando l'ordine cambia (la funzione è chiamata a ogni geocoding)
+    names = [fn.__name__ for fn in providers]
+    if names != _LAST_GEOCODER_ORDER:
+        _LAST_GEOCODER_ORDER[:] = names
+        app.logger.info(f"[geocode] ordine effettivo: {names}")
 
     return providers
 
@@ -213,30 +420,73 @@ def geocode_place(place: str) -> Optional[Dict[str, Any]]:
     # Cache hit
     cached = GEOCODE_CACHE.get(key)
     if cached:
+        ALIAS_STATS["exact_hits"] += 1
         return cached
-    
+
+    # Variante già vista (accenti, paese scritto in altro modo, nome canonico...)
+    aliased = _alias_lookup(place)
+    if aliased:
+        ALIAS_STATS["alias_hits"] += 1
+        GEOCODE_CACHE[key] = aliased
+        return aliased
+    ALIAS_STATS["misses"] += 1
+
+    # Stessa chiave già in ricerca su un altro thread: accodati invece di rifare la chiamata
+    with _INFLIGHT_LOCK:
+        pending = _INFLIGHT.get(key)
+        if pending is None:
+            _INFLIGHT[key] = Event()
+    if pending is not None:
+        GEOCODE_QUEUE_STATS["merged"] += 1
+        pending.wait(min(GEOCODE_MERGE_WAIT, remaining(default=GEOCODE_MERGE_WAIT)))
+        return GEOCODE_CACHE.get(key)
+
+    try:
+        return _geocode_uncached(place, key)
+    finally:
+        with _INFLIGHT_LOCK:
+            done = _INFLIGHT.pop(key, None)
+        if done is not None:
+            done.set()
+
+def _geocode_record(place: str, key: str, res: Dict[str, Any]) -> Dict[str, Any]:
+    """Risultato di un provider: cache, indice alias e contatori (comune a sync e async)."""
+    GEOCODE_CACHE[key] = res
+    _alias_learn(place, res)
+    # 👇👇 AGGIUNGI QUI
+    GEOCODE_PROVIDER_COUNTS[res.get("source","unknown")] += 1
+    LAST_GEOCODE_HIT.update({
+        "source": res.get("source"),
+        "name": res.get("name"),
+        "lat": float(res.get("lat")) if res.get("lat") is not None else None,
+        "lon": float(res.get("lon")) if res.get("lon") is not None else None,
+    })
+    # 👆👆
+    # 👇 aggiungi qui
+    if res.get("source") == "google":
+        _bump("google_calls")
+    # 👆
+    return res
+
+def _geocode_uncached(place: str, key: str) -> Optional[Dict[str, Any]]:
     # invece della lista fissa
     # OLD Version: providers = [geocode_google, geocode_nominatim, geocode_openmeteo, geocode_mapsco]
     providers = get_geocoder_order()
     for prov in providers:
+        limiter = RATE_LIMITERS.get(prov.__name__.replace("geocode_", ""))
+        wait = min(GEOCODER_RATE_WAIT, remaining(default=GEOCODER_RATE_WAIT))
+        if limiter is not None and not limiter.acquire(wait):
+            # bucket vuoto: niente sleep, si prova il provider successivo
+            GEOCODE_QUEUE_STATS["rate_limited_skips"] += 1
+            continue
         try:
             res = prov(place)
             if res and "lat" in res and "lon" in res:
-                GEOCODE_CACHE[key] = res
-                # 👇👇 AGGIUNGI QUI
-                GEOCODE_PROVIDER_COUNTS[res.get("source","unknown")] += 1
-                LAST_GEOCODE_HIT.update({
-                    "source": res.get("source"),
-                    "name": res.get("name"),
-                    "lat": float(res.get("lat")) if res.get("lat") is not None else None,
-                    "lon": float(res.get("lon")) if res.get("lon") is not None else None,
-                })
-                # 👆👆
-                # 👇 aggiungi qui
-                if res.get("source") == "google":
-                    _bump("google_calls")
-                # 👆
-                return res
+                return _geocode_record(place, key, res)
+        except DeadlineExceeded:
+            # budget della richiesta finito: inutile provare gli altri provider
+            app.logger.warning(f"geocode deadline exceeded at provider {prov.__name__}")
+            break
         except Exception as e:
             app.logger.warning(f"geocode provider {prov.__name__} error: {e}")
     return None
@@ -479,11 +729,14 @@ def _require_api_key():
 #        if key != API_KEY:
 #            return jsonify({"error": "Invalid or missing API key"}), 403
 
+# ---- Access log strutturato: un record JSON per richiesta tracciata (vedi access_log.py) ----
+app.after_request(access_log.emit)
+
 # ---- CORS (open while testing; restrict in production) ----
 @app.after_request
 def add_cors_headers(resp):
     resp.headers["Access-Control-Allow-Origin"] = "*"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-API-Key"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-API-Key, X-Profile, X-Profile-Token"
     resp.headers["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
     return resp
 
@@ -510,10 +763,34 @@ def format_deg(deg: float) -> str:
         d += 1; m = 0
     return f"{d}°{m:02d}'"
 
+# Sistemi di case supportati (Placidus, Koch, Porphyry, Regiomontanus, Campanus, Alcabitius, Vehlow)
+HOUSE_SYSTEMS = "PKORCBV"
+
 def ensure_house_system(hsys: str) -> str:
     if not hsys: return "P"
     h = hsys.upper().strip()
-    return h if h in list("PKORCBV") else "P"
+    return h if h in list(HOUSE_SYSTEMS) else "P"
+
+def parse_house_systems(value) -> list:
+    """
+    Interpreta il campo opzionale 'house_systems' del payload.
+    Accetta "all"/"*", una stringa tipo "P,K,O" oppure una lista ["P", "K"].
+    I valori non supportati vengono ignorati; ritorna [] se il campo manca.
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        if value.strip().lower() in ("all", "*"):
+            return list(HOUSE_SYSTEMS)
+        value = value.split(",")
+    if not isinstance(value, (list, tuple)):
+        return []
+    out = []
+    for v in value:
+        h = str(v).upper().strip()
+        if h in list(HOUSE_SYSTEMS) and h not in out:   # un solo carattere: "PK" e "" non valgono
+            out.append(h)
+    return out
 
 def _calc_ut_tuple(jd_ut, pid, flags):
     """Normalize swe.calc_ut return to a flat 6-floats tuple."""
@@ -532,6 +809,85 @@ PLANETS = [
     (swe.PLUTO, "Pluto")
 ]
 
+# --- Cache di calcolo condivise tra sistemi di case ---
+# Pianeti e tempo siderale dipendono solo dal Julian Day (e dalla longitudine),
+# le cuspidi si cachano per sistema: cambiare sistema non ricalcola i pianeti.
+PLANETS_CACHE = TTLCache(maxsize=4000, ttl=3600)
+SIDEREAL_CACHE = TTLCache(maxsize=4000, ttl=3600)
+HOUSES_CACHE = TTLCache(maxsize=8000, ttl=3600)
+
+def calc_planets(jd_ut: float) -> dict:
+    """Blocco pianeti per un Julian Day (UT), calcolato una sola volta."""
+    hit = PLANETS_CACHE.get(jd_ut)
+    if hit is not None:
+        return hit
+    flags = swe.FLG_SWIEPH | swe.FLG_SPEED
+    positions = {}
+    for pid, pname in PLANETS:
+        lon_deg, lat_deg, dist, slon, slat, sdist = _calc_ut_tuple(jd_ut, pid, flags)
+        sign, deg_in_sign, absdeg = lon_to_sign_deg(lon_deg)
+        positions[pname] = {
+            "longitude": round(absdeg, 6),
+            "sign": sign,
+            "deg_in_sign": round(deg_in_sign, 6),
+            "deg_str": format_deg(deg_in_sign),
+            "speed_lon": round(slon, 6),
+        }
+    PLANETS_CACHE[jd_ut] = positions
+    return positions
+
+def sidereal_frame(jd_ut: float, lon: float) -> Tuple[float, float]:
+    """
+    (ARMC, obliquità vera) in gradi: è la parte comune a tutti i sistemi di case.
+    Stessa formula di swe.houses_ex: ARMC = tempo siderale apparente * 15 + longitudine.
+    """
+    key = (jd_ut, round(lon, 6))
+    hit = SIDEREAL_CACHE.get(key)
+    if hit is not None:
+        return hit
+    eps = _calc_ut_tuple(jd_ut, swe.ECL_NUT, 0)[0]
+    armc = (swe.sidtime(jd_ut) * 15.0 + lon) % 360.0
+    SIDEREAL_CACHE[key] = (armc, eps)
+    return armc, eps
+
+class HouseSystemError(RuntimeError):
+    """Sistema di case non calcolabile per questa posizione (es. Placidus/Koch oltre il circolo polare)."""
+
+# Placidus e Koch non sono definiti per |lat| >= 90° - obliquità (swisseph solleva errore)
+POLAR_HOUSE_SYSTEMS = "PK"
+
+def house_system_supported(hsys: str, lat: float, eps: float) -> bool:
+    return hsys not in POLAR_HOUSE_SYSTEMS or abs(lat) < 90.0 - eps
+
+def calc_houses(jd_ut: float, lat: float, lon: float, hsys: str) -> dict:
+    """Cuspidi + ASC/MC per un sistema, a partire dall'ARMC condiviso (cache per sistema)."""
+    key = (jd_ut, round(lat, 6), round(lon, 6), hsys)
+    hit = HOUSES_CACHE.get(key)
+    if hit is not None:
+        return hit
+    armc, eps = sidereal_frame(jd_ut, lon)
+    if not house_system_supported(hsys, lat, eps):
+        raise HouseSystemError(f"house system {hsys} undefined at latitude {lat:.2f}")
+    try:
+        cusps, ascmc = swe.houses_armc(armc, lat, eps, hsys.encode("ascii"))
+    except Exception as e:
+        # qualunque altro errore di swisseph è un errore interno, non "latitudine"
+        raise RuntimeError(f"Houses calculation failed ({hsys}): {e}")
+
+    houses = {str(i + 1): round(float(cusps[i]), 6) for i in range(12)}
+    angles = {}
+    for label, val in (("ASC", ascmc[0]), ("MC", ascmc[1])):
+        sign, deg_in_sign, absdeg = lon_to_sign_deg(float(val))
+        angles[label] = {
+            "longitude": round(absdeg, 6),
+            "sign": sign,
+            "deg_in_sign": round(deg_in_sign, 6),
+            "deg_str": format_deg(deg_in_sign)
+        }
+    res = {"houses": houses, "angles": angles}
+    HOUSES_CACHE[key] = res
+    return res
+
 # ---- Public endpoints ----
 @app.get("/astro-stats")
 def astro_stats():
@@ -563,13 +919,27 @@ def astro_stats():
 
         "cache": {
             "natal_entries":   len(NATAL_CACHE),
+            "natal_hits":      dict(NATAL_CACHE_STATS),
+            "json_encoder":    "orjson" if orjson is not None else "json",
             "geocode_entries": len(GEOCODE_CACHE),
+            "alias_entries":   len(ALIAS_INDEX),
             "tz_entries":      len(TZ_CACHE),
+            "tz_grid":         get_grid() is not None,
+            "tz_lookups":      dict(TZ_LOOKUP_STATS),
+            "planets_entries": len(PLANETS_CACHE),
+            "houses_entries":  len(HOUSES_CACHE),
+            "acg_entries":     len(ACG_CACHE),
+            "calendar_years":  sorted(CALENDAR_YEARS.keys()),
+            "calendar_building": sorted(_CALENDAR_PENDING),
+            "calendar_failed": sorted(CALENDAR_FAILED.keys()),
+            "calendar":        dict(CALENDAR_STATS),
         },
         "concurrency": {
             "max_parallel": MAX_CONC,
             "available_token_estimate": current_available,
         },
+        "http": http_stats(),
+        "access_log": dict(access_log.STATS),
         "health": "ok",
     }, 200
 
@@ -586,6 +956,16 @@ def google_usage():
         "geocoder_order": [fn.__name__ for fn in get_geocoder_order()],
         "geocode_provider_counts": dict(GEOCODE_PROVIDER_COUNTS),
         "last_geocode_hit": LAST_GEOCODE_HIT,
+        "rate_limits": {name: lim.snapshot() for name, lim in RATE_LIMITERS.items()},
+        "merged_lookups": GEOCODE_QUEUE_STATS.get("merged", 0),
+        # hit della cache esatta vs indice alias (misses = chiamate ai provider)
+        "geocode_cache": {
+            "exact_hits": ALIAS_STATS.get("exact_hits", 0),
+            "alias_hits": ALIAS_STATS.get("alias_hits", 0),
+            "misses": ALIAS_STATS.get("misses", 0),
+            "alias_entries": len(ALIAS_INDEX),
+        },
+        "rate_limited_skips": GEOCODE_QUEUE_STATS.get("rate_limited_skips", 0),
 
         # ⬇️ campi aggiunti per compatibilità con lo script PS
         "calls_today": STATS["daily"]["google_calls"],
@@ -612,8 +992,67 @@ def healthz():
 # consenti max 6 /natal in parallelo; le altre attendono
 NATAL_SEM = BoundedSemaphore(6)
 
+# budget totale per /natal (I/O esterno incluso): deve restare sotto il --timeout di gunicorn
+NATAL_DEADLINE_SECONDS = float(os.getenv("NATAL_DEADLINE_SECONDS", "30"))
+
 # cache risultati per 1h (regolabile); fino a 2000 chiavi
+# ogni voce tiene la carta + il body JSON già serializzato (cached=true) ed eventualmente gzippato:
+# un hit spedisce i byte così come sono, senza ri-serializzare la struttura annidata
 NATAL_CACHE = TTLCache(maxsize=2000, ttl=3600)
+NATAL_GZIP_MIN_BYTES = int(os.getenv("NATAL_GZIP_MIN_BYTES", "1024"))   # sotto: niente gzip
+NATAL_GZIP_LEVEL = int(os.getenv("NATAL_GZIP_LEVEL", "6"))
+NATAL_CACHE_STATS = Counter()
+
+def json_bytes(obj) -> bytes:
+    """JSON compatto con chiavi ordinate (come jsonify): orjson se installato, altrimenti stdlib."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+def encoded_entry(obj, **extra) -> dict:
+    """Body JSON serializzato una volta + copia gzip (se abbastanza grande)."""
+    body = json_bytes(obj)
+    gz = None
+    if NATAL_GZIP_MIN_BYTES >= 0 and len(body) >= NATAL_GZIP_MIN_BYTES:
+        gz = gzip.compress(body, compresslevel=NATAL_GZIP_LEVEL, mtime=0)
+    return {**extra, "body": body, "gzip": gz}
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Accept-Encoding con q-value: gzip (o *, se gzip non è citato) con q > 0. "gzip;q=0" = rifiuto."""
+    weights = {}
+    for part in (accept_encoding or "").lower().split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in weights:
+            return weights[coding] > 0
+    return False
+
+def encoded_body(entry: dict, accept_encoding: str, stats: Counter) -> Tuple[bytes, dict]:
+    """Byte da spedire + header (Content-Encoding se gzip è accettato)."""
+    if entry["gzip"] is not None and accepts_gzip(accept_encoding):
+        stats["gzip_hits"] += 1
+        return entry["gzip"], {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+    stats["identity_hits"] += 1
+    return entry["body"], {"Vary": "Accept-Encoding"}
+
+def natal_cache_entry(result: dict) -> dict:
+    """Voce di NATAL_CACHE: la carta resta intatta, il flag cached vive solo nei byte."""
+    return encoded_entry({**result, "cached": True}, chart=result)
+
+def natal_cached_body(entry: dict, accept_encoding: str) -> Tuple[bytes, dict]:
+    return encoded_body(entry, accept_encoding, NATAL_CACHE_STATS)
 
 def _key_from_payload(p: dict) -> str:
     # costruiamo una chiave deterministica (adatta se NON includi dati sensibili)
@@ -625,113 +1064,115 @@ def _key_from_payload(p: dict) -> str:
         str(p.get("lat", "")),
         str(p.get("lon", "")),
         str(p.get("tz", "")),
+        ensure_house_system(p.get("house_system", "P")),
+        ",".join(parse_house_systems(p.get("house_systems"))),
     ])
 
-def do_natal(data: dict) -> dict:
+def resolve_location(place: str, geo: Optional[Dict[str, Any]] = None) -> dict:
+    """Geocoding + fuso orario di un luogo (cache, alias, griglia dei fusi).
+    geo: risultato di geocoding già risolto (es. dai geocoder async di asgi.py)."""
+    if geo is None:
+        with access_log.stage("geocode"):
+            geo = geocode_place(place)
+    if not geo:
+        raise RuntimeError(f"Geocoding failed for '{place}' (providers exhausted). Try 'City, Country'")
+    lat, lon = float(geo["lat"]), float(geo["lon"])
+    access_log.annotate(geocoder=geo.get("source", "unknown"))
+
+    # Time zone (cache globale + griglia / TimezoneFinder)
+    with access_log.stage("timezone"):
+        tzname = resolve_timezone(lat, lon)
+    if not tzname:
+        raise RuntimeError("Timezone not found for coordinates")
+    return {
+        "place": place,
+        "resolved_place": geo.get("name", place), "geocoder": geo.get("source", "unknown"),
+        "lat": lat, "lon": lon, "timezone": tzname,
+    }
+
+def resolve_birth(data: dict, geo: Optional[Dict[str, Any]] = None) -> dict:
+    """
+    Parte comune agli endpoint basati su una nascita: geocoding, fuso orario,
+    conversione locale -> UTC e Julian Day (UT).
+    """
     name = (data.get("name") or "Unknown").strip() if isinstance(data.get("name"), str) else "Unknown"
     date_str = data.get("date")
     time_str = data.get("time", "12:00")
     place = data.get("place")
-    hsys = ensure_house_system(data.get("house_system", "P"))
 
     if not date_str or not place:
         raise ValueError("Missing required fields: 'date' and 'place'")
 
-    # Geocoding
-    geo = geocode_place(place)
-    if not geo:
-        raise RuntimeError(f"Geocoding failed for '{place}' (providers exhausted). Try 'City, Country'")
-    lat, lon = float(geo["lat"]), float(geo["lon"])
-    resolved_place = geo.get("name", place)
-    geocoder_source = geo.get("source", "unknown")
-    app.logger.info(f"[natal] geocoder={geocoder_source} place='{place}' -> '{resolved_place}' ({lat},{lon})")
-
-    # Time zone (cache globale + TimezoneFinder globale)
-    tzname = resolve_timezone(lat, lon)
-    if not tzname:
-        raise RuntimeError("Timezone not found for coordinates")
-    tz = pytz.timezone(tzname)
+    loc = resolve_location(place, geo)
+    tzname = loc["timezone"]
 
-    # Localize -> UTC con gestione DST
+    # Locale -> UTC: ricerca binaria nella tabella delle transizioni del fuso (DST incluso)
     year, month, day = map(int, date_str.split("-"))
     hh, mm = map(int, time_str.split(":"))
     naive = datetime(year, month, day, hh, mm, 0)
-    try:
-        local_dt = tz.localize(naive, is_dst=None)
-    except AmbiguousTimeError:
-        local_dt = tz.localize(naive, is_dst=True)
-    except NonExistentTimeError:
-        local_dt = tz.localize(naive) + timedelta(hours=1)
-
-    utc_dt = local_dt.astimezone(pytz.utc)
+    with access_log.stage("utc"):
+        local_dt, utc_dt = local_to_utc(
+            tzname, naive, ambiguous=TZ_AMBIGUOUS_POLICY, nonexistent=TZ_NONEXISTENT_POLICY
+        )
 
     # Julian Day (UT)
     ut_hour = utc_dt.hour + utc_dt.minute/60 + utc_dt.second/3600
     jd_ut = swe.julday(utc_dt.year, utc_dt.month, utc_dt.day, ut_hour, swe.GREG_CAL)
 
-    # Planets
-    flags = swe.FLG_SWIEPH | swe.FLG_SPEED
-    positions = {}
-    for pid, pname in PLANETS:
-        lon_deg, lat_deg, dist, slon, slat, sdist = _calc_ut_tuple(jd_ut, pid, flags)
-        sign, deg_in_sign, absdeg = lon_to_sign_deg(lon_deg)
-        positions[pname] = {
-            "longitude": round(absdeg, 6),
-            "sign": sign,
-            "deg_in_sign": round(deg_in_sign, 6),
-            "deg_str": format_deg(deg_in_sign),
-            "speed_lon": round(slon, 6),
-        }
+    return {
+        "name": name, **loc,
+        "local_dt": local_dt, "utc_dt": utc_dt, "jd_ut": jd_ut,
+    }
 
-    # Houses/Angles
-    try:
-        try:
-            cusps, ascmc = swe.houses_ex(jd_ut, lat, lon, hsys)
-        except TypeError:
-            cusps, ascmc = swe.houses_ex(jd_ut, lat, lon, hsys.encode("ascii"))
-    except Exception as e:
-        raise RuntimeError(f"Houses calculation failed: {e}")
+def birth_input(b: dict) -> dict:
+    """Blocco "input" delle risposte, uguale per tutti gli endpoint."""
+    return {
+        "name": b["name"],
+        "place_query": b["place"],
+        "resolved_place": b["resolved_place"],
+        "geocoder": b["geocoder"],
+        "lat": b["lat"], "lon": b["lon"],
+        "timezone": b["timezone"],
+        "local_datetime": b["local_dt"].isoformat(),
+        "utc_datetime": b["utc_dt"].isoformat(),
+    }
 
-    houses = {str(i + 1): round(float(cusps[i]), 6) for i in range(12)}
-    asc = float(ascmc[0]); mc = float(ascmc[1])
-    asc_sign, asc_deg_in_sign, asc_abs = lon_to_sign_deg(asc)
-    mc_sign, mc_deg_in_sign, mc_abs = lon_to_sign_deg(mc)
+def do_natal(data: dict, geo: Optional[Dict[str, Any]] = None) -> dict:
+    hsys = ensure_house_system(data.get("house_system", "P"))
+    birth = resolve_birth(data, geo)
+    jd_ut, lat, lon = birth["jd_ut"], birth["lat"], birth["lon"]
 
-    return {
-        "input": {
-            "name": name,
-            "place_query": place,
-            "resolved_place": resolved_place,
-            "geocoder": geocoder_source,
-            "lat": lat, "lon": lon,
-            "timezone": tzname,
-            "local_datetime": local_dt.isoformat(),
-            "utc_datetime": utc_dt.isoformat(),
-            "house_system": hsys
-        },
+    # Planets (una volta per Julian Day, condivisi tra i sistemi di case)
+    with access_log.stage("planets"):
+        positions = calc_planets(jd_ut)
+
+    # Houses/Angles: sistema principale + eventuali sistemi extra richiesti
+    with access_log.stage("houses"):
+        primary = calc_houses(jd_ut, lat, lon, hsys)
+    extra_systems = parse_house_systems(data.get("house_systems"))
+
+    result = {
+        "input": {**birth_input(birth), "house_system": hsys},
         "positions": positions,
-        "angles": {
-            "ASC": {
-                "longitude": round(asc_abs, 6),
-                "sign": asc_sign,
-                "deg_in_sign": round(asc_deg_in_sign, 6),
-                "deg_str": format_deg(asc_deg_in_sign)
-            },
-            "MC": {
-                "longitude": round(mc_abs, 6),
-                "sign": mc_sign,
-                "deg_in_sign": round(mc_deg_in_sign, 6),
-                "deg_str": format_deg(mc_deg_in_sign)
-            }
-        },
-        "houses": houses,
+        "angles": primary["angles"],
+        "houses": primary["houses"],
         "cached": False
     }
-
-# ---- Main API ----
-@app.post("/natal")
-def natal():
-    # --- robust input parsing: JSON or form, with raw fallback ---
+    if extra_systems:
+        # stesso ARMC/obliquità per tutti: ogni sistema costa solo swe.houses_armc
+        with access_log.stage("house_systems"):
+            systems = {}
+            for h in extra_systems:
+                # un sistema non calcolabile (P/K ai poli) non deve far fallire tutta la carta
+                try:
+                    systems[h] = calc_houses(jd_ut, lat, lon, h)
+                except HouseSystemError:
+                    systems[h] = {"error": "unsupported at this latitude"}
+            result["house_systems"] = systems
+    return result
+
+def read_payload() -> dict:
+    """Body della richiesta: JSON o form, con fallback sul raw."""
     data = request.get_json(silent=True)
     if not data:
         if request.form:
@@ -743,11 +1184,20 @@ def natal():
                 data = _json.loads(raw) if raw else {}
             except Exception:
                 data = {}
+    return data
+
+# ---- Main API ----
+@app.post("/natal")
+def natal():
+    access_log.begin(method=request.method, path=request.path)
+    # --- robust input parsing: JSON or form, with raw fallback ---
+    data = read_payload()
 
     # --- validazione minima: fields essenziali (adatta ai tuoi) ---
     required = ("date", "time", "place")  # aggiungi/varia se usi lat/lon/tz obbligatori
     missing = [f for f in required if not data.get(f)]
     if missing:
+        access_log.annotate(cache="invalid")
         return {"error": f"missing fields: {', '.join(missing)}"}, 400
     _bump("natal_calls")
     # 👇 AGGIUNGI QUESTA RIGA
@@ -756,32 +1206,748 @@ def natal():
     cached = NATAL_CACHE.get(cache_key)
     if cached is not None:
         _bump("cache_hits")
-        return cached, 200
+        access_log.annotate(cache="hit", geocoder=cached["chart"]["input"].get("geocoder"))
+        body, headers = natal_cached_body(cached, request.headers.get("Accept-Encoding", ""))
+        return Response(body, status=200, mimetype="application/json", headers=headers)
 
     # --- controllo concorrenza per non saturare i thread ---
+    t_wait = time.perf_counter()
     acquired = NATAL_SEM.acquire(timeout=2)  # non bloccare all'infinito
+    access_log.annotate(sem_wait_ms=round((time.perf_counter() - t_wait) * 1000, 2))
     if not acquired:
+        access_log.annotate(cache="busy")
         return {"error": "busy, try again"}, 429
 
-    t0 = time.perf_counter()
+    access_log.annotate(cache="miss")
     try:
         # >>> QUI richiami la tua funzione reale di calcolo <<<
         # IMPORTANTE: dentro do_natal usa timeout+retry per I/O esterno (geocoding, timezone, ecc.)
-        result = do_natal(data)   # <-- la tua funzione esistente
-
-        # salva in cache e rispondi
-        NATAL_CACHE[cache_key] = result
-        return result, 200
+        # profiling on-demand (header autorizzato o campionamento): spento = nessun costo
+        prof_mode = profiling.requested_mode(request.headers)
+        prof_meta = {"path": request.path, "date": data.get("date"), "time": data.get("time"),
+                     "place": data.get("place"), "house_system": data.get("house_system", "P")}
+        # deadline: geocoding e retry HTTP si adattano al budget residuo
+        with profiling.profiled(prof_mode, prof_meta) as prof, deadline_scope(NATAL_DEADLINE_SECONDS):
+            result = do_natal(data)   # <-- la tua funzione esistente
+        if prof is not None:
+            access_log.annotate(profile_id=prof["id"])
+
+        # salva in cache (già serializzata) e rispondi
+        NATAL_CACHE[cache_key] = natal_cache_entry(result)
+        return Response(json_bytes(result), status=200, mimetype="application/json")
+
+    except HouseSystemError as e:
+        # input valido ma sistema principale non definito a questa latitudine (P/K ai poli)
+        access_log.annotate(error=type(e).__name__)
+        return {"error": f"house system {ensure_house_system(data.get('house_system', 'P'))} "
+                         "unsupported at this latitude"}, 400
 
     except Exception as e:
         # log utile per capire i colli di bottiglia
         app.logger.exception("natal failed: %s", e)
+        access_log.annotate(error=type(e).__name__)
         return {"error": "internal error"}, 500
 
     finally:
-        dur_ms = (time.perf_counter() - t0) * 1000
-        app.logger.info("natal_ms=%.1f", dur_ms)
         NATAL_SEM.release()
 
+# ---- Astrocartografia (linee ASC/DSC/MC/IC dei pianeti) ----
+# Calcolo analitico "in mundo" da ascensione retta α, declinazione δ e tempo siderale
+# apparente di Greenwich θ (gradi), vettoriale su tutte le latitudini:
+#   MC: longitudine λ = α - θ              IC: λ + 180
+#   ASC/DSC: cos H0 = -tan φ · tan δ  ->  λ = α ∓ H0 - θ   (solo dove |tan φ · tan δ| <= 1)
+# Le linee dipendono solo dal Julian Day: cache per jd + parametri di campionamento.
+ACG_CACHE = TTLCache(maxsize=500, ttl=3600)
+ACG_LAT_MAX = 80.0          # oltre, le linee ASC/DSC diventano quasi orizzontali e poco leggibili
+ACG_LAT_STEP = 0.5          # passo di campionamento in latitudine (gradi)
+ACG_TOLERANCE = 0.05        # tolleranza di semplificazione Douglas-Peucker (gradi)
+
+def _wrap180(x):
+    return (x + 180.0) % 360.0 - 180.0
+
+def _simplify(points, tol: float):
+    """Douglas-Peucker iterativo su un array (n, 2); tiene estremi e punti oltre tol."""
+    n = len(points)
+    if n <= 2 or tol <= 0:
+        return points
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        a, b = points[i], points[j]
+        seg = points[i + 1:j]
+        d = b - a
+        norm = np.hypot(d[0], d[1])
+        if norm == 0:
+            dist = np.hypot(seg[:, 0] - a[0], seg[:, 1] - a[1])
+        else:
+            dist = np.abs(d[0] * (seg[:, 1] - a[1]) - d[1] * (seg[:, 0] - a[0])) / norm
+        k = int(np.argmax(dist))
+        if dist[k] > tol:
+            m = i + 1 + k
+            keep[m] = True
+            stack.append((i, m))
+            stack.append((m, j))
+    return points[keep]
+
+def _polylines(lons, lats, tol: float) -> list:
+    """Spezza una curva su NaN e sull'antimeridiano, semplifica, ritorna [[lon, lat], ...]."""
+    out = []
+    valid = ~np.isnan(lons)
+    # nuovo segmento dove la curva si interrompe o salta di oltre 180° in longitudine
+    breaks = np.ones(len(lons), dtype=bool)
+    breaks[1:] = ~valid[:-1] | (np.abs(np.diff(np.nan_to_num(lons))) > 180.0)
+    seg_id = np.cumsum(breaks)
+    for sid in np.unique(seg_id[valid]):
+        mask = valid & (seg_id == sid)
+        if np.count_nonzero(mask) < 2:
+            continue
+        pts = _simplify(np.column_stack((lons[mask], lats[mask])), tol)
+        out.append(np.round(pts, 4).tolist())
+    return out
+
+def astrocartography_lines(jd_ut: float, lat_step: float = ACG_LAT_STEP,
+                           lat_max: float = ACG_LAT_MAX, tol: float = ACG_TOLERANCE) -> dict:
+    key = (jd_ut, lat_step, lat_max, tol)
+    hit = ACG_CACHE.get(key)
+    if hit is not None:
+        return hit
+
+    flags = swe.FLG_SWIEPH | swe.FLG_EQUATORIAL
+    eq = np.array([_calc_ut_tuple(jd_ut, pid, flags)[:2] for pid, _ in PLANETS])
+    ra, dec = eq[:, 0:1], eq[:, 1:2]                        # (pianeti, 1)
+    gast = swe.sidtime(jd_ut) * 15.0
+
+    lats = np.arange(-lat_max, lat_max + lat_step / 2, lat_step)   # (latitudini,)
+    x = -np.tan(np.radians(lats))[None, :] * np.tan(np.radians(dec))
+    with np.errstate(invalid="ignore"):
+        h0 = np.degrees(np.arccos(np.where(np.abs(x) <= 1.0, x, np.nan)))   # (pianeti, latitudini)
+    asc = _wrap180(ra - h0 - gast)
+    dsc = _wrap180(ra + h0 - gast)
+    mc = _wrap180(ra[:, 0] - gast)
+
+    lines = {}
+    for i, (_, pname) in enumerate(PLANETS):
+        mc_lon, ic_lon = round(float(mc[i]), 4), round(float(_wrap180(mc[i] + 180.0)), 4)
+        lines[pname] = {
+            "ASC": _polylines(asc[i], lats, tol),
+            "DSC": _polylines(dsc[i], lats, tol),
+            "MC": [[[mc_lon, -lat_max], [mc_lon, lat_max]]],
+            "IC": [[[ic_lon, -lat_max], [ic_lon, lat_max]]],
+        }
+    res = {
+        "lines": lines,
+        "gast_deg": round(gast % 360.0, 6),
+        "equatorial": {pname: {"ra": round(float(eq[i, 0]), 6), "dec": round(float(eq[i, 1]), 6)}
+                       for i, (_, pname) in enumerate(PLANETS)},
+    }
+    ACG_CACHE[key] = res
+    return res
+
+def _float_arg(data: dict, name: str, default: float, lo: float, hi: float) -> float:
+    try:
+        v = float(data.get(name, default))
+    except (TypeError, ValueError):
+        return default
+    return min(max(v, lo), hi)
+
+@app.post("/astrocartography")
+def astrocartography():
+    access_log.begin(method=request.method, path=request.path)
+    data = read_payload()
+    missing = [f for f in ("date", "time", "place") if not data.get(f)]
+    if missing:
+        return {"error": f"missing fields: {', '.join(missing)}"}, 400
+
+    acquired = NATAL_SEM.acquire(timeout=2)
+    if not acquired:
+        return {"error": "busy, try again"}, 429
+    try:
+        with deadline_scope(NATAL_DEADLINE_SECONDS):
+            birth = resolve_birth(data)
+        with access_log.stage("lines"):
+            res = astrocartography_lines(
+                birth["jd_ut"],
+                lat_step=_float_arg(data, "lat_step", ACG_LAT_STEP, 0.1, 5.0),
+                lat_max=_float_arg(data, "lat_max", ACG_LAT_MAX, 10.0, 89.0),
+                tol=_float_arg(data, "tolerance", ACG_TOLERANCE, 0.0, 2.0),
+            )
+        return {
+            "input": birth_input(birth),
+            "coordinates": "lon,lat",
+            **res,
+        }, 200
+    except Exception as e:
+        app.logger.exception("astrocartography failed: %s", e)
+        access_log.annotate(error=type(e).__name__)
+        return {"error": "internal error"}, 500
+    finally:
+        NATAL_SEM.release()
+
+# ---- Ricerca elettiva (finestre temporali su un luogo fisso) ----
+# Luogo e fuso si risolvono una volta. Il periodo viene campionato a passo grosso
+# (step_minutes) con swe.houses_ex/_calc_ut_tuple; cuspidi, angoli e pianeti vengono
+# interpolati al minuto e i vincoli valutati su array. Solo i bordi delle finestre
+# candidate vengono ricalcolati esattamente, minuto per minuto. I risultati escono
+# in streaming (NDJSON) blocco per blocco man mano che vengono trovati.
+ELECTIONAL_SEM = BoundedSemaphore(2)
+ELECTIONAL_MAX_DAYS = int(os.getenv("ELECTIONAL_MAX_DAYS", "183"))
+ELECTIONAL_STEP_MINUTES = 20
+ELECTIONAL_CHUNK_DAYS = 7
+ELECTIONAL_MAX_RESULTS = 1000
+UNIX_EPOCH_JD = 2440587.5
+
+PLANET_IDS = {pname: pid for pid, pname in PLANETS}
+ASPECT_ANGLES = {"conjunction": 0.0, "sextile": 60.0, "square": 90.0, "trine": 120.0, "opposition": 180.0}
+ANGLE_POINTS = ("ASC", "MC")
+
+def _parse_constraints(raw) -> Tuple[list, list]:
+    """Valida i vincoli; ritorna (vincoli normalizzati, pianeti da calcolare)."""
+    if not isinstance(raw, list) or not raw:
+        raise ValueError("'constraints' must be a non-empty list")
+    bodies = set(PLANET_IDS) | set(ANGLE_POINTS)
+    out, planets = [], set()
+
+    def body(name):
+        b = str(name or "").strip()
+        b = b.upper() if b.upper() in ANGLE_POINTS else b.capitalize()
+        if b not in bodies:
+            raise ValueError(f"unknown body: {name!r}")
+        if b in PLANET_IDS:
+            planets.add(b)
+        return b
+
+    def sign(name):
+        sg = str(name or "").strip().capitalize()
+        if sg not in ZODIAC_SIGNS:
+            raise ValueError(f"unknown sign: {name!r}")
+        return ZODIAC_SIGNS.index(sg)
+
+    for c in raw:
+        if not isinstance(c, dict):
+            raise ValueError(f"each constraint must be an object, got {c!r}")
+        kind = c.get("type")
+        if kind == "asc_sign":
+            out.append({"type": kind, "sign": sign(c.get("sign"))})
+        elif kind == "planet_sign":
+            out.append({"type": kind, "body": body(c.get("planet")), "sign": sign(c.get("sign"))})
+        elif kind == "planet_in_house":
+            house = int(c.get("house", 0))
+            if not 1 <= house <= 12:
+                raise ValueError("house must be 1..12")
+            out.append({"type": kind, "body": body(c.get("planet")), "house": house})
+        elif kind == "aspect":
+            angle = c.get("angle", ASPECT_ANGLES.get(str(c.get("aspect", "")).lower()))
+            if angle is None:
+                raise ValueError(f"unknown aspect: {c.get('aspect')!r}")
+            out.append({"type": kind, "a": body(c.get("a")), "b": body(c.get("b")),
+                        "angle": float(angle), "orb": float(c.get("orb", 6.0))})
+        else:
+            raise ValueError(f"unknown constraint type: {kind!r}")
+    return out, sorted(planets)
+
+def _exact_state(t_utc, lat: float, lon: float, hsys: str, planets: list) -> dict:
+    """Cuspidi, ASC/MC e longitudini dei pianeti esatte negli istanti UTC (secondi epoch)."""
+    jds = np.asarray(t_utc, dtype=np.float64) / 86400.0 + UNIX_EPOCH_JD
+    n = len(jds)
+    cusps = np.empty((n, 12))
+    asc, mc = np.empty(n), np.empty(n)
+    pl = {p: np.empty(n) for p in planets}
+    hsys_b = hsys.encode("ascii")
+    for i, jd in enumerate(jds):
+        c, a = swe.houses_ex(float(jd), lat, lon, hsys_b)
+        cusps[i] = c[:12]
+        asc[i], mc[i] = a[0], a[1]
+        for p in planets:
+            pl[p][i] = _calc_ut_tuple(float(jd), PLANET_IDS[p], swe.FLG_SWIEPH)[0]
+    return {"cusps": cusps, "ASC": asc, "MC": mc, **pl}
+
+def _interp_angles(x_coarse, y, x_fine):
+    """Interpolazione lineare di angoli (gradi) senza salti a 360°."""
+    unwrapped = np.degrees(np.unwrap(np.radians(y)))
+    return np.interp(x_fine, x_coarse, unwrapped) % 360.0
+
+def _interp_state(state: dict, x_coarse, x_fine) -> dict:
+    out = {}
+    for k, v in state.items():
+        if k == "cusps":
+            out[k] = np.column_stack([_interp_angles(x_coarse, v[:, h], x_fine) for h in range(12)])
+        else:
+            out[k] = _interp_angles(x_coarse, v, x_fine)
+    return out
+
+def _eval_constraints(state: dict, constraints: list):
+    """Maschera booleana: tutti i vincoli soddisfatti in ciascun istante."""
+    n = len(state["ASC"])
+    mask = np.ones(n, dtype=bool)
+    for c in constraints:
+        if c["type"] == "asc_sign":
+            mask &= (state["ASC"] // 30).astype(int) == c["sign"]
+        elif c["type"] == "planet_sign":
+            mask &= (state[c["body"]] // 30).astype(int) == c["sign"]
+        elif c["type"] == "planet_in_house":
+            cusps, h = state["cusps"], c["house"] - 1
+            start, nxt = cusps[:, h], cusps[:, (h + 1) % 12]
+            mask &= ((state[c["body"]] - start) % 360.0) < ((nxt - start) % 360.0)
+        elif c["type"] == "aspect":
+            sep = np.abs((state[c["a"]] - state[c["b"]] + 180.0) % 360.0 - 180.0)
+            mask &= np.abs(sep - c["angle"]) <= c["orb"]
+    return mask
+
+def _runs(mask):
+    """Indici [inizio, fine) delle sequenze di True."""
+    d = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(d == 1), np.flatnonzero(d == -1)))
+
+def _refine_edge(t, is_start, ctx, radius_min):
+    """Bordo esatto (al minuto) vicino a t; None se attorno a t il vincolo non regge mai."""
+    lo = max(ctx["t0"], t - radius_min * 60.0)
+    hi = min(ctx["t1"], t + radius_min * 60.0)
+    grid = np.arange(lo, hi + 1.0, 60.0)
+    ok = _eval_constraints(_exact_state(grid, *ctx["args"]), ctx["constraints"])
+    if not ok.any():
+        return None
+    if is_start:
+        edges = [i for i in range(len(ok)) if ok[i] and (i == 0 or not ok[i - 1])]
+        cand = [grid[i] for i in edges]
+    else:
+        edges = [i for i in range(len(ok)) if ok[i] and (i == len(ok) - 1 or not ok[i + 1])]
+        cand = [grid[i] + 60.0 for i in edges]
+    return min(cand, key=lambda x: abs(x - t))
+
+def _fmt_time(t_utc: float, tzname: str) -> Tuple[str, str]:
+    off = float(utc_offsets_many(tzname, [t_utc])[0])
+    utc = datetime(1970, 1, 1) + timedelta(seconds=t_utc)
+    local = (utc + timedelta(seconds=off)).replace(tzinfo=timezone(timedelta(seconds=off)))
+    return local.isoformat(), utc.replace(tzinfo=timezone.utc).isoformat()
+
+def electional_windows(ctx: dict):
+    """Generatore delle finestre (start, end) in secondi UTC, blocco per blocco."""
+    t0, t1, step = ctx["t0"], ctx["t1"], ctx["step"]
+    radius = max(2, min(30, int(step / 60 / 2)))
+    chunk = ELECTIONAL_CHUNK_DAYS * 86400.0
+    pending = None   # inizio di una finestra arrivata al bordo del blocco precedente
+
+    def finalize(a, b):
+        if a > t0:
+            a = _refine_edge(a, True, ctx, radius)
+        if b < t1 and a is not None:
+            b = _refine_edge(b, False, ctx, radius)
+        if a is None or b is None or b <= a:
+            return None
+        mid = _exact_state([(a + b) / 2.0], *ctx["args"])
+        return (a, b) if _eval_constraints(mid, ctx["constraints"])[0] else None
+
+    cur = t0
+    while cur < t1:
+        end = min(cur + chunk, t1)
+        coarse = np.arange(cur, end + step, step)
+        fine = np.arange(cur, end, 60.0)
+        state = _interp_state(_exact_state(coarse, *ctx["args"]), coarse, fine)
+        runs = [(fine[s], fine[e - 1] + 60.0) for s, e in _runs(_eval_constraints(state, ctx["constraints"]))]
+        if pending is not None:
+            if runs and runs[0][0] == cur:
+                runs[0] = (pending, runs[0][1])
+            else:
+                w = finalize(pending, cur)
+                if w:
+                    yield w
+            pending = None
+        for a, b in runs:
+            if b >= end and end < t1:
+                pending = a
+                continue
+            w = finalize(a, b)
+            if w:
+                yield w
+        cur = end
+    if pending is not None:
+        w = finalize(pending, t1)
+        if w:
+            yield w
+
+def _local_epoch(value: str, tzname: str) -> float:
+    naive = datetime.fromisoformat(str(value))
+    _, utc_dt = local_to_utc(tzname, naive, ambiguous=TZ_AMBIGUOUS_POLICY, nonexistent=TZ_NONEXISTENT_POLICY)
+    return (utc_dt - datetime(1970, 1, 1, tzinfo=timezone.utc)).total_seconds()
+
+@app.post("/electional")
+def electional():
+    access_log.begin(method=request.method, path=request.path, streamed=True)
+    data = read_payload()
+    missing = [f for f in ("start", "end", "constraints") if not data.get(f)]
+    if not data.get("place") and (data.get("lat") is None or data.get("lon") is None):
+        missing.append("place (or lat/lon)")
+    if missing:
+        return {"error": f"missing fields: {', '.join(missing)}"}, 400
+
+    try:
+        constraints, planets = _parse_constraints(data.get("constraints"))
+        hsys = ensure_house_system(data.get("house_system", "P"))
+        if data.get("tz"):
+            try:
+                pytz.timezone(data["tz"])
+            except pytz.UnknownTimeZoneError:
+                raise ValueError(f"unknown timezone: {data['tz']}")
+        if data.get("lat") is not None and data.get("lon") is not None:
+            lat, lon = float(data["lat"]), float(data["lon"])
+            loc = {"place": data.get("place"), "resolved_place": data.get("place"), "geocoder": "input",
+                   "lat": lat, "lon": lon, "timezone": data.get("tz") or resolve_timezone(lat, lon)}
+        else:
+            with deadline_scope(NATAL_DEADLINE_SECONDS):
+                loc = resolve_location(data["place"])
+        t0 = _local_epoch(data["start"], loc["timezone"])
+        t1 = _local_epoch(data["end"], loc["timezone"])
+        step = _float_arg(data, "step_minutes", ELECTIONAL_STEP_MINUTES, 5, 120) * 60.0
+        max_results = int(_float_arg(data, "max_results", 100, 1, ELECTIONAL_MAX_RESULTS))
+        # P/K ai poli: meglio un 400 subito che un 200 seguito da una riga di errore nello stream
+        _, eps = sidereal_frame(t0 / 86400.0 + UNIX_EPOCH_JD, loc["lon"])
+        if not house_system_supported(hsys, loc["lat"], eps):
+            raise ValueError(f"house system {hsys} is undefined at latitude {loc['lat']:.2f}; "
+                             f"use one of {''.join(h for h in HOUSE_SYSTEMS if h not in POLAR_HOUSE_SYSTEMS)}")
+    except (ValueError, TypeError) as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        app.logger.exception("electional setup failed: %s", e)
+        return {"error": "internal error"}, 500
+    if not t0 < t1 or t1 - t0 > ELECTIONAL_MAX_DAYS * 86400:
+        return {"error": f"'end' must follow 'start' by at most {ELECTIONAL_MAX_DAYS} days"}, 400
+
+    if not ELECTIONAL_SEM.acquire(timeout=2):
+        return {"error": "busy, try again"}, 429
+
+    ctx = {"t0": t0, "t1": t1, "step": step, "constraints": constraints,
+           "args": (loc["lat"], loc["lon"], hsys, planets)}
+
+    def generate():
+        started = time.perf_counter()
+        count = 0
+        try:
+            yield json.dumps({"type": "meta", "location": loc, "house_system": hsys,
+                              "constraints": data.get("constraints")}) + "\n"
+            for a, b in electional_windows(ctx):
+                start_local, start_utc = _fmt_time(a, loc["timezone"])
+                end_local, end_utc = _fmt_time(b, loc["timezone"])
+                yield json.dumps({"type": "window", "start_local": start_local, "end_local": end_local,
+                                  "start_utc": start_utc, "end_utc": end_utc,
+                                  "duration_min": round((b - a) / 60.0)}) + "\n"
+                count += 1
+                if count >= max_results:
+                    break
+            yield json.dumps({"type": "done", "count": count,
+                              "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}) + "\n"
+        except Exception as e:
+            app.logger.exception("electional search failed: %s", e)
+            yield json.dumps({"type": "error", "error": "internal error"}) + "\n"
+
+    resp = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    # rilascio alla chiusura della risposta: vale anche se il client si disconnette prima
+    resp.call_on_close(ELECTIONAL_SEM.release)
+    return resp
+
+# ---- Calendario lunare (fasi, ingressi, Luna vuota di corso, eclissi) per anno ----
+# Gli eventi di un anno si calcolano una volta sola: campionamento ogni CALENDAR_STEP_HOURS
+# delle longitudini (via _calc_ut_tuple), individuazione degli attraversamenti sulle serie
+# "srotolate" (elongazione Luna-Sole, longitudine della Luna, distanza Luna-pianeta sono
+# sempre crescenti) e istante esatto con regula falsi. Le eclissi vengono da swisseph.
+# Il risultato è un artefatto compatto (tempi in secondi epoch UTC) salvato gzippato in
+# CALENDAR_DIR e tenuto in memoria; gli anni mancanti si generano in background.
+CALENDAR_DIR = os.getenv("CALENDAR_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "calendar"))
+CALENDAR_MIN_YEAR = int(os.getenv("CALENDAR_MIN_YEAR", "1800"))   # copertura delle effemeridi
+CALENDAR_MAX_YEAR = int(os.getenv("CALENDAR_MAX_YEAR", "2399"))
+CALENDAR_VERSION = 1
+# a passo 12h la Luna si sposta al più ~8° rispetto a qualunque corpo: un solo attraversamento
+# per intervallo anche per bersagli distanti 30° (segni, aspetti)
+CALENDAR_STEP_HOURS = 12
+CALENDAR_PAD_DAYS = 3       # margine ai bordi dell'anno (ingresso precedente per la Luna vuota)
+CALENDAR_YEARS = TTLCache(maxsize=50, ttl=7*24*3600)        # anno -> artefatto
+CALENDAR_RESPONSES = TTLCache(maxsize=200, ttl=24*3600)     # (anno, fuso) -> body serializzato
+CALENDAR_STATS = Counter()
+# anni la cui generazione è fallita: per CALENDAR_RETRY_SECONDS si risponde 503 invece di
+# rilanciare lo stesso job (e di promettere 202 + Retry-After all'infinito)
+CALENDAR_RETRY_SECONDS = int(os.getenv("CALENDAR_RETRY_SECONDS", "600"))
+CALENDAR_FAILED = TTLCache(maxsize=100, ttl=CALENDAR_RETRY_SECONDS)
+_CALENDAR_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="calendar")
+_CALENDAR_PENDING: Dict[int, Any] = {}
+_CALENDAR_LOCK = Lock()
+
+LUNAR_PHASES = {0.0: "new_moon", 90.0: "first_quarter", 180.0: "full_moon", 270.0: "last_quarter"}
+# aspetti tolemaici della Luna (angolo di separazione crescente 0..360)
+VOC_ASPECTS = {0.0: "conjunction", 60.0: "sextile", 90.0: "square", 120.0: "trine",
+               180.0: "opposition", 240.0: "trine", 270.0: "square", 300.0: "sextile"}
+
+def _jd_to_epoch(jd: float) -> int:
+    return int(round((jd - UNIX_EPOCH_JD) * 86400.0))
+
+def _moon_minus(jd: float, pid: int) -> float:
+    moon = _calc_ut_tuple(jd, swe.MOON, swe.FLG_SWIEPH)[0]
+    if pid is None:
+        return moon
+    return moon - _calc_ut_tuple(jd, pid, swe.FLG_SWIEPH)[0]
+
+def _crossing_time(pid, target: float, t0: float, t1: float, tol: float = 1e-6) -> float:
+    """Istante in [t0, t1] in cui (Luna - corpo) vale target (mod 360): regula falsi (Illinois)."""
+    f = lambda t: float(_wrap180(_moon_minus(t, pid) - target))
+    f0, f1 = f(t0), f(t1)
+    side = 0
+    for _ in range(60):
+        t = t1 - f1 * (t1 - t0) / (f1 - f0) if f1 != f0 else 0.5 * (t0 + t1)
+        ft = f(t)
+        if abs(ft) < 1e-9 or (t1 - t0) < tol:
+            return t
+        if (ft < 0) == (f0 < 0):
+            t0, f0 = t, ft
+            if side == -1:
+                f1 *= 0.5
+            side = -1
+        else:
+            t1, f1 = t, ft
+            if side == 1:
+                f0 *= 0.5
+            side = 1
+    return t
+
+def _crossings(jd, series, period: float, targets) -> list:
+    """(indice del campione, target) dove la serie crescente supera target + k*period."""
+    out = []
+    for a in targets:
+        k = np.floor((series - a) / period)
+        out.extend((int(i), a) for i in np.nonzero(np.diff(k) > 0)[0])
+    return out
+
+def build_calendar(year: int) -> dict:
+    """Eventi lunari dell'anno (UTC) in forma compatta: righe [epoch, ...]."""
+    jd_start = swe.julday(year, 1, 1, 0.0, swe.GREG_CAL)
+    jd_end = swe.julday(year + 1, 1, 1, 0.0, swe.GREG_CAL)
+    jd = np.arange(jd_start - CALENDAR_PAD_DAYS, jd_end + CALENDAR_PAD_DAYS, CALENDAR_STEP_HOURS / 24.0)
+    lons = {pid: np.array([_calc_ut_tuple(float(t), pid, swe.FLG_SWIEPH)[0] for t in jd]) for pid, _ in PLANETS}
+    moon = np.unwrap(lons[swe.MOON], period=360.0)
+    in_year = lambda t: jd_start <= t < jd_end
+
+    phases = []
+    for i, a in _crossings(jd, np.unwrap(lons[swe.MOON] - lons[swe.SUN], period=360.0), 360.0, LUNAR_PHASES):
+        t = _crossing_time(swe.SUN, a, jd[i], jd[i + 1])
+        if in_year(t):
+            phases.append([_jd_to_epoch(t), LUNAR_PHASES[a], round(_moon_minus(t, None) % 360.0, 4)])
+
+    ingresses = []   # [jd, segno] anche nei margini: servono per la Luna vuota di corso
+    for i, _a in _crossings(jd, moon, 30.0, [0.0]):
+        t = _crossing_time(None, np.floor(moon[i + 1] / 30.0) * 30.0 % 360.0, jd[i], jd[i + 1])
+        ingresses.append([t, int((_moon_minus(t, None) % 360.0 + 1e-7) // 30) % 12])
+    ingresses.sort()
+
+    aspects = []     # [jd, pianeta, aspetto]
+    for pid, pname in PLANETS:
+        if pid == swe.MOON:
+            continue
+        sep = np.unwrap(lons[swe.MOON] - lons[pid], period=360.0)
+        for i, a in _crossings(jd, sep, 360.0, VOC_ASPECTS):
+            aspects.append([_crossing_time(pid, a, jd[i], jd[i + 1]), pname, VOC_ASPECTS[a]])
+    aspects.sort()
+
+    # Luna vuota di corso: dall'ultimo aspetto esatto nel segno fino all'ingresso nel successivo
+    void, k = [], 0
+    for (t_prev, _), (t_next, sign_next) in zip(ingresses, ingresses[1:]):
+        last = None
+        while k < len(aspects) and aspects[k][0] < t_next:
+            if aspects[k][0] >= t_prev:
+                last = aspects[k]
+            k += 1
+        start = last[0] if last else t_prev
+        if t_next >= jd_start and start < jd_end:
+            void.append([_jd_to_epoch(start), _jd_to_epoch(t_next),
+                         last[1] if last else None, last[2] if last else None, sign_next])
+
+    eclipses = []
+    for kind, when, types in (
+        ("solar", swe.sol_eclipse_when_glob,
+         ((swe.ECL_ANNULAR_TOTAL, "hybrid"), (swe.ECL_TOTAL, "total"),
+          (swe.ECL_ANNULAR, "annular"), (swe.ECL_PARTIAL, "partial"))),
+        ("lunar", swe.lun_eclipse_when,
+         ((swe.ECL_TOTAL, "total"), (swe.ECL_PARTIAL, "partial"), (swe.ECL_PENUMBRAL, "penumbral"))),
+    ):
+        t = jd_start
+        while True:
+            flags, tret = when(t, swe.FLG_SWIEPH)
+            if tret[0] >= jd_end:
+                break
+            etype = next((name for bit, name in types if flags & bit), "partial")
+            eclipses.append([_jd_to_epoch(tret[0]), kind, etype, round(_moon_minus(tret[0], None) % 360.0, 4)])
+            t = tret[0] + 1.0
+    eclipses.sort()
+
+    return {
+        "year": year, "version": CALENDAR_VERSION,
+        "phases": phases,
+        "ingresses": [[_jd_to_epoch(t), s] for t, s in ingresses if in_year(t)],
+        "void_of_course": void,
+        "eclipses": eclipses,
+    }
+
+def _calendar_path(year: int) -> str:
+    return os.path.join(CALENDAR_DIR, f"lunar_{year}.json.gz")
+
+def _calendar_from_disk(year: int) -> Optional[dict]:
+    try:
+        with gzip.open(_calendar_path(year), "rb") as fh:
+            data = json.loads(fh.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        app.logger.warning(f"calendar {year}: artefatto illeggibile ({e}), lo rigenero")
+        return None
+    return data if data.get("version") == CALENDAR_VERSION else None
+
+def _calendar_save(year: int, data: dict):
+    """Scrittura atomica dell'artefatto gzippato in CALENDAR_DIR."""
+    os.makedirs(CALENDAR_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CALENDAR_DIR, prefix=".part-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(gzip.compress(json_bytes(data), mtime=0))
+        os.replace(tmp, _calendar_path(year))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _calendar_job(year: int) -> dict:
+    t0 = time.perf_counter()
+    data = build_calendar(year)
+    # prima in memoria: il calcolo è riuscito anche se il disco non è scrivibile
+    CALENDAR_YEARS[year] = data
+    CALENDAR_STATS["built"] += 1
+    try:
+        _calendar_save(year, data)
+    except OSError as e:
+        CALENDAR_STATS["save_errors"] += 1
+        app.logger.warning(f"calendar {year}: salvataggio in {CALENDAR_DIR} non riuscito ({e}), solo in memoria")
+    app.logger.info(f"calendar {year} generato in {time.perf_counter() - t0:.1f}s")
+    return data
+
+class CalendarBuildError(RuntimeError):
+    pass
+
+def _calendar_done(year: int, fut):
+    exc = fut.exception()
+    with _CALENDAR_LOCK:
+        if exc is not None:
+            CALENDAR_FAILED[year] = f"{type(exc).__name__}: {exc}"
+        _CALENDAR_PENDING.pop(year, None)
+    if exc is not None:
+        CALENDAR_STATS["build_errors"] += 1
+        app.logger.error(f"calendar {year} failed: {exc}")
+
+def get_calendar(year: int) -> Optional[dict]:
+    """
+    Artefatto dell'anno (memoria, poi disco); None = generazione avviata in background.
+    CalendarBuildError se l'ultima generazione è fallita da meno di CALENDAR_RETRY_SECONDS.
+    """
+    data = CALENDAR_YEARS.get(year)
+    if data is not None:
+        return data
+    data = _calendar_from_disk(year)
+    if data is not None:
+        CALENDAR_YEARS[year] = data
+        return data
+    fut = None
+    with _CALENDAR_LOCK:
+        failed = CALENDAR_FAILED.get(year)
+        if failed is not None:
+            raise CalendarBuildError(failed)
+        if year not in _CALENDAR_PENDING:
+            fut = _CALENDAR_POOL.submit(_calendar_job, year)
+            _CALENDAR_PENDING[year] = fut
+    if fut is not None:
+        # fuori dal lock: se il job è già finito la callback gira subito in questo thread
+        fut.add_done_callback(lambda f, y=year: _calendar_done(y, f))
+    return None
+
+def render_calendar(data: dict, tzname: Optional[str]) -> dict:
+    """Artefatto compatto -> risposta leggibile, tempi ISO in UTC o nel fuso richiesto."""
+    def when(ts: int) -> str:
+        utc = datetime(1970, 1, 1) + timedelta(seconds=ts)
+        if not tzname:
+            return utc.isoformat() + "Z"
+        off = int(offsets[ts])
+        return (utc + timedelta(seconds=off)).replace(tzinfo=timezone(timedelta(seconds=off))).isoformat()
+
+    def where(lon: float) -> dict:
+        sign, deg_in_sign, _ = lon_to_sign_deg(lon)
+        return {"sign": sign, "deg_in_sign": round(deg_in_sign, 4), "deg_str": format_deg(deg_in_sign)}
+
+    offsets = {}
+    if tzname:
+        stamps = sorted({r[0] for key in ("phases", "ingresses", "eclipses") for r in data[key]}
+                        | {t for r in data["void_of_course"] for t in r[:2]})
+        offsets = dict(zip(stamps, utc_offsets_many(tzname, stamps).tolist()))
+    return {
+        "year": data["year"],
+        "timezone": tzname or "UTC",
+        "phases": [{"time": when(t), "phase": ph, **where(lon)} for t, ph, lon in data["phases"]],
+        "ingresses": [{"time": when(t), "sign": ZODIAC_SIGNS[s]} for t, s in data["ingresses"]],
+        "void_of_course": [
+            {"start": when(a), "end": when(b), "next_sign": ZODIAC_SIGNS[s],
+             "last_aspect": {"planet": p, "aspect": asp} if p else None}
+            for a, b, p, asp, s in data["void_of_course"]
+        ],
+        "eclipses": [{"time": when(t), "kind": kind, "type": etype, **where(lon)}
+                     for t, kind, etype, lon in data["eclipses"]],
+    }
+
+@app.get("/calendar/<int:year>")
+def calendar(year):
+    if not CALENDAR_MIN_YEAR <= year <= CALENDAR_MAX_YEAR:
+        return {"error": f"year must be {CALENDAR_MIN_YEAR}..{CALENDAR_MAX_YEAR}"}, 400
+    tzname = (request.args.get("tz") or "").strip() or None
+    if tzname:
+        try:
+            pytz.timezone(tzname)
+        except pytz.UnknownTimeZoneError:
+            return {"error": f"unknown timezone: {tzname}"}, 400
+
+    entry = CALENDAR_RESPONSES.get((year, tzname))
+    if entry is None:
+        try:
+            data = get_calendar(year)
+        except CalendarBuildError:
+            return ({"error": "calendar generation failed", "year": year}, 503,
+                    {"Retry-After": str(CALENDAR_RETRY_SECONDS)})
+        if data is None:
+            # generazione in corso: il client riprova (tipicamente pochi secondi)
+            return {"status": "building", "year": year}, 202, {"Retry-After": "5"}
+        entry = encoded_entry(render_calendar(data, tzname))
+        CALENDAR_RESPONSES[(year, tzname)] = entry
+    body, headers = encoded_body(entry, request.headers.get("Accept-Encoding", ""), CALENDAR_STATS)
+    return Response(body, status=200, mimetype="application/json", headers=headers)
+
+# ---- Admin: profili catturati (richiede X-Profile-Token = PROFILE_TOKEN) ----
+@app.get("/admin/profiles")
+def admin_profiles():
+    if not profiling.authorized(request.headers):
+        return {"error": "forbidden"}, 403
+    return {"profiles": profiling.list_profiles()}, 200
+
+@app.get("/admin/profiles/<profile_id>")
+def admin_profile_download(profile_id):
+    if not profiling.authorized(request.headers):
+        return {"error": "forbidden"}, 403
+    rec = profiling.get_profile(profile_id)
+    if rec is None:
+        return {"error": "profile not found"}, 404
+    fmt = request.args.get("format") or ("pstats" if "pstats" in rec else "collapsed")
+    if fmt not in rec:
+        return {"error": f"format '{fmt}' not available for {rec['mode']} profile"}, 400
+    if fmt == "pstats":
+        # caricabile con pstats.Stats(<file>) o snakeviz
+        return Response(rec["pstats"], mimetype="application/octet-stream", headers={
+            "Content-Disposition": f"attachment; filename=natal-{profile_id}.pstats"})
+    # una riga per stack: "frame;frame;frame <campioni>" (flamegraph.pl, speedscope)
+    return Response(rec["collapsed"], mimetype="text/plain", headers={
+        "Content-Disposition": f"attachment; filename=natal-{profile_id}.collapsed.txt"})
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=DEBUG)
\ No newline at end of file
@@ -0,0 +1,291 @@
+# asgi.py
+"""
+Entry point ASGI (Starlette) accanto all'app Flask di app.py.
+
+Stesse route principali (/natal, /astro-stats, /google-usage, /, /health, /healthz),
+ma senza un thread bloccato per ogni richiesta in attesa dei geocoder:
+  - i provider di geocoding sono chiamate async su un unico httpx.AsyncClient
+    con pool di connessioni condiviso (stessi URL/parametri/parsing di app.py,
+    tramite GEOCODER_SPECS), con rate limit per provider e merge delle ricerche
+    duplicate come nella versione sync;
+  - il lavoro Swiss Ephemeris (case, pianeti, fusi) va su un ThreadPoolExecutor
+    limitato (ASGI_SWE_WORKERS), così l'event loop non si blocca mai;
+  - oltre ASGI_MAX_INFLIGHT /natal in corso si risponde subito 429.
+Cache (geocoding, alias, fusi, carte) e contatori sono quelli di app.py: le due
+entry point espongono le stesse statistiche.
+
+Avvio:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+"""
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qsl
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import app as core
+from http_utils import RETRY_TOTAL, RETRY_BACKOFF, RETRY_STATUS, DEFAULT_TIMEOUT, retry_after_seconds
+
+ASGI_MAX_INFLIGHT = int(os.getenv("ASGI_MAX_INFLIGHT", "64"))      # /natal contemporanee
+ASGI_SWE_WORKERS = int(os.getenv("ASGI_SWE_WORKERS", "4"))         # thread per swisseph
+ASGI_HTTP_MAX_CONNECTIONS = int(os.getenv("ASGI_HTTP_MAX_CONNECTIONS", "20"))
+ASGI_HTTP_KEEPALIVE = int(os.getenv("ASGI_HTTP_KEEPALIVE", "10"))
+
+STATS = {"natal_inflight": 0, "natal_rejected": 0, "natal_timeouts": 0,
+         "provider_calls": 0, "provider_errors": 0}
+
+_CLIENT: Optional[httpx.AsyncClient] = None
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_NATAL_SLOTS: Optional[asyncio.Semaphore] = None
+# ricerche in corso (stesso event loop, nessun lock): i duplicati attendono la prima
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+@asynccontextmanager
+async def lifespan(_app):
+    global _CLIENT, _EXECUTOR, _NATAL_SLOTS
+    connect, read = DEFAULT_TIMEOUT
+    _CLIENT = httpx.AsyncClient(
+        timeout=httpx.Timeout(read, connect=connect),
+        limits=httpx.Limits(max_connections=ASGI_HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=ASGI_HTTP_KEEPALIVE),
+        headers={"User-Agent": core.GEOCODER_UA},
+    )
+    _EXECUTOR = ThreadPoolExecutor(max_workers=ASGI_SWE_WORKERS, thread_name_prefix="swe")
+    _NATAL_SLOTS = asyncio.Semaphore(ASGI_MAX_INFLIGHT)
+    try:
+        yield
+    finally:
+        await _CLIENT.aclose()
+        _EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+async def run_swe(fn, *args):
+    """Esegue una funzione bloccante (swisseph, fusi) sull'executor limitato."""
+    return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, fn, *args)
+
+# --- Geocoding async ---
+async def _provider_get_async(name: str, url: str, params=None, headers=None) -> httpx.Response:
+    """
+    GET con retry (stessa politica di http_utils): con rate limit nessun retry (il
+    token preso vale per una sola richiesta) e su 429 bucket bloccato per il
+    Retry-After, come _provider_get in app.py.
+    """
+    limiter = core.RATE_LIMITERS.get(name)
+    retries = 0 if limiter is not None else RETRY_TOTAL
+    attempt = 0
+    while True:
+        STATS["provider_calls"] += 1
+        try:
+            r = await _CLIENT.get(url, params=params, headers=headers)
+        except httpx.TransportError:
+            STATS["provider_errors"] += 1
+            if attempt >= retries:
+                raise
+        else:
+            if r.status_code == 429 and limiter is not None:
+                limiter.penalize(retry_after_seconds(r))
+                return r
+            if r.status_code not in RETRY_STATUS or attempt >= retries:
+                return r
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+        attempt += 1
+
+async def _run_provider_async(name: str, place: str) -> Optional[Dict[str, Any]]:
+    build, parse = core.GEOCODER_SPECS[name]
+    req = build(place)
+    if req is None:
+        return None
+    url, kw = req
+    r = await _provider_get_async(name, url, **kw)
+    if r.status_code != 200:
+        return None
+    return parse(r.json(), place)
+
+async def _acquire_async(limiter) -> bool:
+    """Token dal bucket attendendo al più GEOCODER_RATE_WAIT, senza bloccare l'event loop."""
+    budget = core.GEOCODER_RATE_WAIT
+    while True:
+        need = limiter.try_acquire()
+        if need == 0.0:
+            return True
+        if need > budget:
+            limiter.deny()
+            return False
+        budget -= need
+        await asyncio.sleep(need)
+
+async def _geocode_uncached_async(place: str, key: str) -> Optional[Dict[str, Any]]:
+    for prov in core.get_geocoder_order():
+        name = prov.__name__.replace("geocode_", "")
+        limiter = core.RATE_LIMITERS.get(name)
+        if limiter is not None and not await _acquire_async(limiter):
+            core.GEOCODE_QUEUE_STATS["rate_limited_skips"] += 1
+            continue
+        try:
+            res = await _run_provider_async(name, place)
+            if res and "lat" in res and "lon" in res:
+                return core._geocode_record(place, key, res)
+        except Exception as e:
+            core.app.logger.warning(f"geocode provider {prov.__name__} error: {e}")
+    return None
+
+async def geocode_place_async(place: str) -> Optional[Dict[str, Any]]:
+    """Come app.geocode_place (cache, alias, merge dei duplicati), ma async."""
+    if not place or not place.strip():
+        return None
+    key = core._norm_place(place)
+
+    cached = core.GEOCODE_CACHE.get(key)
+    if cached:
+        core.ALIAS_STATS["exact_hits"] += 1
+        return cached
+    aliased = core._alias_lookup(place)
+    if aliased:
+        core.ALIAS_STATS["alias_hits"] += 1
+        core.GEOCODE_CACHE[key] = aliased
+        return aliased
+    core.ALIAS_STATS["misses"] += 1
+
+    pending = _INFLIGHT.get(key)
+    if pending is not None:
+        core.GEOCODE_QUEUE_STATS["merged"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(pending), core.GEOCODE_MERGE_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        return core.GEOCODE_CACHE.get(key)
+
+    done = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = done
+    try:
+        return await _geocode_uncached_async(place, key)
+    finally:
+        _INFLIGHT.pop(key, None)
+        done.set_result(None)
+
+# --- Route ---
+async def read_payload(request: Request) -> dict:
+    """Body della richiesta: JSON o form urlencoded, con fallback sul raw."""
+    raw = await request.body()
+    if not raw:
+        return {}
+    text = raw.decode("utf-8", errors="replace")
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data
+    except ValueError:
+        pass
+    if "application/x-www-form-urlencoded" in request.headers.get("content-type", ""):
+        return dict(parse_qsl(text))
+    return {}
+
+async def natal(request: Request):
+    data = await read_payload(request)
+    required = ("date", "time", "place")
+    missing = [f for f in required if not data.get(f)]
+    if missing:
+        return JSONResponse({"error": f"missing fields: {', '.join(missing)}"}, 400)
+    core._bump("natal_calls")
+    cache_key = core._key_from_payload(data)
+    cached = core.NATAL_CACHE.get(cache_key)
+    if cached is not None:
+        core._bump("cache_hits")
+        body, headers = core.natal_cached_body(cached, request.headers.get("accept-encoding", ""))
+        return Response(body, headers=headers, media_type="application/json")
+
+    # backpressure: a slot esauriti si risponde subito invece di accodare
+    if _NATAL_SLOTS.locked():
+        STATS["natal_rejected"] += 1
+        return JSONResponse({"error": "busy, try again"}, 429)
+
+    async with _NATAL_SLOTS:
+        STATS["natal_inflight"] += 1
+        try:
+            async def compute():
+                geo = await geocode_place_async(data["place"])
+                if not geo:
+                    raise RuntimeError(f"Geocoding failed for '{data['place']}' (providers exhausted)")
+                return await run_swe(core.do_natal, data, geo)
+            result = await asyncio.wait_for(compute(), core.NATAL_DEADLINE_SECONDS)
+        except asyncio.TimeoutError:
+            STATS["natal_timeouts"] += 1
+            return JSONResponse({"error": "timeout"}, 504)
+        except core.HouseSystemError:
+            # stessa risposta di app.natal: P/K oltre il circolo polare
+            hsys = core.ensure_house_system(data.get("house_system", "P"))
+            return JSONResponse({"error": f"house system {hsys} unsupported at this latitude"}, 400)
+        except Exception as e:
+            core.app.logger.exception("natal (asgi) failed: %s", e)
+            return JSONResponse({"error": "internal error"}, 500)
+        finally:
+            STATS["natal_inflight"] -= 1
+
+    core.NATAL_CACHE[cache_key] = core.natal_cache_entry(result)
+    return Response(core.json_bytes(result), media_type="application/json")
+
+async def astro_stats(request: Request):
+    body, status = core.astro_stats()
+    body["asgi"] = {
+        **STATS,
+        "max_inflight": ASGI_MAX_INFLIGHT,
+        "swe_workers": ASGI_SWE_WORKERS,
+        "geocode_inflight": len(_INFLIGHT),
+    }
+    return JSONResponse(body, status)
+
+async def google_usage(request: Request):
+    body, status = core.google_usage()
+    return JSONResponse(body, status)
+
+async def index(request: Request):
+    return JSONResponse({
+        "status": "ok",
+        "service": "houseofvenus-astrocalc",
+        "time_utc": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + "Z",
+    })
+
+async def health(request: Request):
+    return JSONResponse({"status": "ok"})
+
+# --- API key + CORS (stesse regole di app.py) ---
+class _ApiKeyCors(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        need_key = os.getenv("API_KEY")
+        p = request.url.path
+        if p != "/" and p.endswith("/"):
+            p = p[:-1]
+        if request.method == "OPTIONS":
+            resp = Response(status_code=204)
+        elif need_key and p not in core.PUBLIC_PATHS and \
+                (request.headers.get("X-API-Key") or request.query_params.get("api_key")) != need_key:
+            resp = JSONResponse({"error": "Invalid or missing API key"}, 401)
+        else:
+            resp = await call_next(request)
+        resp.headers["Access-Control-Allow-Origin"] = "*"
+        resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-API-Key, X-Profile, X-Profile-Token"
+        resp.headers["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
+        return resp
+
+app = Starlette(
+    routes=[
+        Route("/", index, methods=["GET", "HEAD"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/healthz", health, methods=["GET"]),
+        Route("/astro-stats", astro_stats, methods=["GET"]),
+        Route("/google-usage", google_usage, methods=["GET"]),
+        Route("/natal", natal, methods=["POST", "OPTIONS"]),
+    ],
+    middleware=[Middleware(_ApiKeyCors)],
+    lifespan=lifespan,
+)
@@ -1,26 +1,256 @@
 # http_utils.py
+import os
+import time
+import random
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 import requests
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
-SESSION = requests.Session()
-_retries = Retry(
-    total=3, backoff_factor=0.5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=["GET", "POST"]
-)
-SESSION.mount("http://", HTTPAdapter(max_retries=_retries))
-SESSION.mount("https://", HTTPAdapter(max_retries=_retries))
+# --- Pool di connessioni ---
+# pool_maxsize per host allineato ai thread del worker (gunicorn --threads 8):
+# con meno connessioni i thread in più aprono/chiudono socket a ogni richiesta.
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))  # host distinti tenuti in pool
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "8"))           # connessioni per host
+# override per host: "nominatim.openstreetmap.org=2,maps.googleapis.com=8"
+HTTP_HOST_POOLS = os.getenv("HTTP_HOST_POOLS", "nominatim.openstreetmap.org=2,geocode.maps.co=2")
+
+# --- Retry (gestiti qui e non da urllib3, per poterli legare alla deadline) ---
+RETRY_TOTAL = int(os.getenv("HTTP_RETRY_TOTAL", "3"))
+RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+MIN_ATTEMPT_SECONDS = 0.2   # sotto questo budget residuo non parte un nuovo tentativo
 
 DEFAULT_TIMEOUT = (5, 20)  # connect, read seconds
 
-def http_get(url, **kw):
-    kw.setdefault("timeout", DEFAULT_TIMEOUT)
-    return SESSION.get(url, **kw)
+SESSION = requests.Session()
+_ADAPTERS = {}
+
+def _mount(prefix, pool_connections, pool_maxsize):
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+    SESSION.mount(prefix, adapter)
+    _ADAPTERS[prefix] = adapter
 
-def http_post(url, **kw):
+_mount("http://", HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE)
+_mount("https://", HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE)
+for _part in HTTP_HOST_POOLS.split(","):
+    _host, _, _size = _part.partition("=")
+    if _host.strip() and _size.strip().isdigit():
+        _mount(f"https://{_host.strip()}", 1, int(_size))
+
+class DeadlineExceeded(requests.Timeout):
+    """Budget della richiesta esaurito prima (o durante) la chiamata HTTP."""
+
+# --- Deadline per richiesta (thread-local) ---
+_local = threading.local()
+
+@contextmanager
+def deadline_scope(seconds):
+    """
+    Imposta una deadline per tutte le chiamate http_get/http_post del thread corrente.
+    Scope annidati non possono allungare la deadline esterna.
+    """
+    outer = getattr(_local, "deadline", None)
+    deadline = time.monotonic() + seconds
+    _local.deadline = deadline if outer is None else min(outer, deadline)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = outer
+
+def current_deadline():
+    return getattr(_local, "deadline", None)
+
+def remaining(deadline=None, default=None):
+    """Secondi rimasti alla deadline (esplicita o del thread); default se non c'è deadline."""
+    deadline = deadline if deadline is not None else current_deadline()
+    if deadline is None:
+        return default
+    return max(0.0, deadline - time.monotonic())
+
+# --- Statistiche per host (per il monitoring) ---
+_STATS = defaultdict(Counter)
+_STATS_LOCK = threading.Lock()
+
+def _count(host, **fields):
+    with _STATS_LOCK:
+        _STATS[host].update(fields)
+
+def _clip_timeout(timeout, budget):
+    if budget is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(min(t, budget) for t in timeout)
+    return min(timeout, budget)
+
+def _backoff(attempt, resp=None, honor_retry_after=True):
+    delay = RETRY_BACKOFF * (2 ** attempt)
+    if honor_retry_after and resp is not None:
+        try:
+            delay = max(delay, float(resp.headers.get("Retry-After", 0)))
+        except (TypeError, ValueError):
+            pass
+    return delay * (0.5 + random.random() / 2)
+
+def _request(method, url, fail_fast=False, deadline=None, retries=None, **kw):
+    """
+    Esegue la richiesta con retry su errori di rete e status in RETRY_STATUS.
+    Con una deadline (argomento o deadline_scope) timeout per tentativo, numero
+    di retry e backoff si riducono al budget residuo; se il budget finisce
+    solleva DeadlineExceeded. fail_fast: nessun retry (provider con rate limit: ogni
+    tentativo consumerebbe una richiesta fuori dal token bucket del chiamante).
+    """
     kw.setdefault("timeout", DEFAULT_TIMEOUT)
-    return SESSION.post(url, **kw)
+    deadline = deadline if deadline is not None else current_deadline()
+    retries = (0 if fail_fast else RETRY_TOTAL) if retries is None else retries
+    host = urlsplit(url).hostname or "?"
+    _count(host, requests=1)
+
+    attempt = 0
+    while True:
+        budget = remaining(deadline)
+        if budget is not None and budget < MIN_ATTEMPT_SECONDS:
+            _count(host, deadline_exceeded=1)
+            raise DeadlineExceeded(f"deadline exceeded before {method} {host}")
+        _count(host, attempts=1)
+        resp, error = None, None
+        try:
+            resp = SESSION.request(method, url, **dict(kw, timeout=_clip_timeout(kw["timeout"], budget)))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            _count(host, errors=1)
+
+        retryable = error is not None or resp.status_code in RETRY_STATUS
+        if resp is not None and resp.status_code == 429:
+            _count(host, status_429=1)
+            retryable = not fail_fast
+        if not retryable or attempt >= retries:
+            if error is not None:
+                raise error
+            return resp
+
+        delay = _backoff(attempt, resp, honor_retry_after=not fail_fast)
+        budget = remaining(deadline)
+        if budget is not None and delay + MIN_ATTEMPT_SECONDS > budget:
+            # il prossimo tentativo non starebbe nel budget: restituisci quello che c'è
+            _count(host, retries_skipped=1)
+            if error is not None:
+                raise error
+            return resp
+        if resp is not None:
+            resp.close()
+        _count(host, retries=1)
+        time.sleep(delay)
+        attempt += 1
+
+def http_get(url, fail_fast=False, deadline=None, **kw):
+    return _request("GET", url, fail_fast=fail_fast, deadline=deadline, **kw)
+
+def http_post(url, fail_fast=False, deadline=None, **kw):
+    return _request("POST", url, fail_fast=fail_fast, deadline=deadline, **kw)
+
+def _pool_stats():
+    out = {}
+    for prefix, adapter in _ADAPTERS.items():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            if pool.pool is None:
+                continue
+            # la coda contiene connessioni libere (o slot None): maxsize - qsize = in uso ora
+            out[f"{pool.scheme}://{pool.host}"] = {
+                "adapter": prefix,
+                "maxsize": pool.pool.maxsize,
+                "in_use": pool.pool.maxsize - pool.pool.qsize(),
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+    return out
+
+def http_stats() -> dict:
+    """Contatori per host (richieste, tentativi, retry, deadline) e stato dei pool."""
+    with _STATS_LOCK:
+        hosts = {h: dict(c) for h, c in _STATS.items()}
+    return {
+        "pool_defaults": {"pool_connections": HTTP_POOL_CONNECTIONS, "pool_maxsize": HTTP_POOL_MAXSIZE},
+        "hosts": hosts,
+        "pools": _pool_stats(),
+    }
+
+def retry_after_seconds(resp, default=1.0):
+    """Legge l'header Retry-After (solo forma in secondi); default se assente/non valido."""
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After", default)))
+    except (TypeError, ValueError):
+        return default
+
+class TokenBucket:
+    """
+    Token bucket thread-safe: 'rate' token al secondo, al massimo 'burst' accumulati.
+    acquire(wait) attende al più 'wait' secondi un token; False se non arriva in tempo.
+    """
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.granted = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """Prende un token se disponibile (ritorna 0.0), altrimenti i secondi da attendere."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                self.granted += 1
+                return 0.0
+            return (1.0 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def acquire(self, wait: float = 0.0) -> bool:
+        deadline = time.monotonic() + max(0.0, wait)
+        while True:
+            need = self.try_acquire()
+            if need == 0.0:
+                return True
+            now = time.monotonic()
+            if now + need > deadline:
+                self.deny()
+                return False
+            time.sleep(need)
+
+    def deny(self):
+        """Conta una richiesta rinunciata per mancanza di token (per chi attende per conto suo)."""
+        with self._lock:
+            self.denied += 1
+
+    def penalize(self, seconds: float):
+        """Blocca il bucket (es. dopo un 429 con Retry-After) e svuota i token."""
+        with self._lock:
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "rate_per_sec": self.rate, "burst": self.burst,
+                "tokens": round(self.tokens, 2),
+                "granted": self.granted, "denied": self.denied,
+            }
 
 # Only for DEBUG (Da qui Sotto in Poi)
 if __name__ == "__main__":
@@ -38,4 +268,6 @@ if __name__ == "__main__":
         print("POST status:", r.status_code)
         print("POST body:", r.json())
     except Exception as e:
-        print("POST failed:", e)
\ No newline at end of file
+        print("POST failed:", e)
+
+    print("Stats:", http_stats())
\ No newline at end of file
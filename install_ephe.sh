@@ -1,13 +1,22 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
-: "${EPHE_FILE_ID:?[ERROR] EPHE_FILE_ID non impostata. Inserisci ID del file ephe.zip su Google Drive.}"
 EPHE_DIR="ephe"
 ZIP_PATH="ephe.zip"
+EPHE_MANIFEST="${EPHE_MANIFEST:-ephe_manifest.json}"
 
 log() { echo "[INFO] $*" >&2; }
 err() { echo "[ERROR] $*" >&2; }
 
+# Percorso preferito: manifest con SHA-256, solo gli anni richiesti, cache locale tra build
+if [[ -f "$EPHE_MANIFEST" ]]; then
+  log "Manifest '$EPHE_MANIFEST' trovato: provisioning verificato (anni ${EPHE_YEARS:-1800-2400})."
+  python3 provision_ephe.py sync --manifest "$EPHE_MANIFEST" --dest "$EPHE_DIR"
+  exit 0
+fi
+
+: "${EPHE_FILE_ID:?[ERROR] EPHE_FILE_ID non impostata. Inserisci ID del file ephe.zip su Google Drive.}"
+
 if [[ -d "$EPHE_DIR" ]]; then
   log "Cartella '$EPHE_DIR' già presente: salto download."
   exit 0
@@ -0,0 +1,126 @@
+# profiling.py
+"""
+Profiling on-demand delle singole richieste.
+
+Si attiva per richiesta con l'header X-Profile (richiede X-Profile-Token uguale a
+PROFILE_TOKEN) oppure a campione con PROFILE_SAMPLE_RATE (0..1). Due modalità:
+  cprofile: cProfile deterministico, esportabile in formato pstats
+  sample:   campionatore a basso overhead (stack del thread ogni PROFILE_SAMPLE_INTERVAL),
+            esportabile come "collapsed stacks" per flamegraph.pl / speedscope
+I profili finiscono in un ring buffer in memoria (PROFILE_RING_SIZE voci).
+Con profiling spento il costo è un confronto su header e sample rate.
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import marshal
+import cProfile
+import pstats
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")             # modalità per il campionamento
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.002"))  # secondi
+MODES = ("cprofile", "sample")
+
+RING = deque(maxlen=PROFILE_RING_SIZE)
+_RING_LOCK = threading.Lock()
+
+def authorized(headers) -> bool:
+    return bool(PROFILE_TOKEN) and headers.get("X-Profile-Token") == PROFILE_TOKEN
+
+def requested_mode(headers):
+    """Modalità di profiling per questa richiesta, None se non va profilata."""
+    want = headers.get("X-Profile")
+    if want and authorized(headers):
+        return want if want in MODES else PROFILE_MODE
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return PROFILE_MODE
+    return None
+
+class _StackSampler(threading.Thread):
+    """Campiona lo stack di un thread a intervalli fissi (stile py-spy, in-process)."""
+
+    def __init__(self, target_ident, interval):
+        super().__init__(daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_evt = threading.Event()
+
+    def run(self):
+        # primo campione subito: anche le richieste più brevi dell'intervallo lasciano traccia
+        while True:
+            frame = sys._current_frames().get(self.target_ident)
+            if frame is not None:
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(parts))] += 1
+            if self._stop_evt.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop_evt.set()
+        self.join()
+
+@contextmanager
+def profiled(mode, meta=None):
+    """Profila il blocco e salva il risultato nel ring buffer (mode=None: niente)."""
+    if not mode:
+        yield None
+        return
+    rec = {
+        "id": uuid.uuid4().hex[:12],
+        "ts": time.time(),
+        "mode": mode,
+        "meta": dict(meta or {}),
+    }
+    t0 = time.perf_counter()
+    prof = sampler = None
+    if mode == "cprofile":
+        prof = cProfile.Profile()
+        prof.enable()
+    else:
+        sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+        sampler.start()
+    try:
+        yield rec
+    finally:
+        if prof is not None:
+            prof.disable()
+            stats = pstats.Stats(prof)
+            rec["pstats"] = marshal.dumps(stats.stats)   # stesso formato di Stats.dump_stats
+            rec["total_calls"] = stats.total_calls
+        if sampler is not None:
+            sampler.stop()
+            rec["collapsed"] = "\n".join(f"{s} {n}" for s, n in sampler.stacks.most_common())
+            rec["samples"] = sum(sampler.stacks.values())
+        rec["duration_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        with _RING_LOCK:
+            RING.append(rec)
+
+def list_profiles() -> list:
+    """Metadati dei profili in memoria (più recenti prima), senza i dati."""
+    with _RING_LOCK:
+        items = list(RING)
+    return [
+        {k: v for k, v in rec.items() if k not in ("pstats", "collapsed")}
+        | {"formats": [f for f in ("pstats", "collapsed") if f in rec]}
+        for rec in reversed(items)
+    ]
+
+def get_profile(profile_id: str):
+    with _RING_LOCK:
+        for rec in RING:
+            if rec["id"] == profile_id:
+                return rec
+    return None
@@ -0,0 +1,265 @@
+"""
+Provisioning verificato e selettivo dei file Swiss Ephemeris.
+
+Al posto di scaricare ed estrarre tutto ephe.zip a ogni build:
+  - legge un manifest JSON (file + SHA-256),
+  - seleziona solo i .se1 che coprono l'intervallo di anni EPHE_YEARS,
+  - scarica in streaming calcolando l'hash durante la scrittura (niente pagine HTML
+    di errore salvate come effemeridi),
+  - tiene una cache locale indirizzata per contenuto (EPHE_CACHE_DIR) riusata tra build,
+  - accetta come sorgente https://, file:// o una cartella locale (mirror offline).
+
+Manifest (es. ephe_manifest.json):
+    {
+      "source": "https://mirror.example/ephe/",       # base URL / file:// / cartella
+      "archive": {"url": "...ephe.zip", "sha256": "..."},  # opzionale: file dentro uno zip
+      "files": [{"name": "sepl_18.se1", "sha256": "...", "size": 484055}, ...]
+    }
+
+Uso:
+    python provision_ephe.py sync [--manifest ephe_manifest.json] [--years 1800-2400]
+    python provision_ephe.py manifest ephe/ --source https://mirror.example/ephe/ > ephe_manifest.json
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+from urllib.request import url2pathname
+
+import requests
+
+EPHE_DIR = os.environ.get("EPHE_PATH", "ephe")
+EPHE_MANIFEST = os.environ.get("EPHE_MANIFEST", "ephe_manifest.json")
+EPHE_CACHE_DIR = os.environ.get("EPHE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "astrocalc-ephe"))
+EPHE_YEARS = os.environ.get("EPHE_YEARS", "1800-2400")
+EPHE_SOURCE = os.environ.get("EPHE_SOURCE", "")        # sovrascrive "source" del manifest (mirror)
+EPHE_WORKERS = int(os.environ.get("EPHE_WORKERS", "4"))
+
+CHUNK_SIZE = 65536
+SE1_SPAN_YEARS = 600
+# sepl_18.se1 = pianeti 1800-2400, semo_ = Luna, seas_ = asteroidi; "m" = anni avanti Cristo
+_SE1_RE = re.compile(r"^se(pl|mo|as)(_|m)(\d{2})\.se1$")
+
+
+class ProvisionError(Exception):
+    pass
+
+
+def _log(msg):
+    print(msg, flush=True)
+
+
+def file_years(name: str):
+    """Intervallo di anni [inizio, fine) coperto da un file .se1; None per gli altri file."""
+    m = _SE1_RE.match(name)
+    if not m:
+        return None
+    start = int(m.group(3)) * 100
+    if m.group(2) == "m":
+        start = -start
+    return start, start + SE1_SPAN_YEARS
+
+
+def parse_years(spec: str):
+    a, _, b = spec.partition("-")
+    if spec.startswith("-"):   # "-3000-2400"
+        a, _, b = spec[1:].partition("-")
+        a = "-" + a
+    return int(a), int(b or a)
+
+
+def select_files(files: list, years) -> list:
+    """File che intersecano l'intervallo di anni; i non-.se1 (es. sefstars.txt) sempre inclusi."""
+    lo, hi = years
+    out = []
+    for f in files:
+        span = file_years(f["name"])
+        if span is None or (span[0] <= hi and lo < span[1]):
+            out.append(f)
+    return out
+
+
+def _cache_path(sha256: str) -> str:
+    return os.path.join(EPHE_CACHE_DIR, sha256[:2], sha256)
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _open_source(url: str):
+    """Stream binario da https://, file:// o percorso locale."""
+    scheme = urlsplit(url).scheme
+    if scheme in ("http", "https"):
+        r = requests.get(url, stream=True, timeout=(10, 60))
+        if r.status_code != 200:
+            r.close()
+            raise ProvisionError(f"HTTP {r.status_code} per {url}")
+        r.raw.decode_content = True
+        return r.raw
+    path = url2pathname(urlsplit(url).path) if scheme == "file" else url
+    return open(path, "rb")
+
+
+def _store_stream(stream, expected_sha: str, label: str) -> str:
+    """Copia uno stream nella cache calcolando l'hash in scrittura; verifica e ritorna il path."""
+    os.makedirs(EPHE_CACHE_DIR, exist_ok=True)
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=EPHE_CACHE_DIR, prefix=".part-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+                out.write(chunk)
+        digest = h.hexdigest()
+        if expected_sha and digest != expected_sha:
+            raise ProvisionError(f"SHA-256 non valido per {label}: {digest} != {expected_sha}")
+        dest = _cache_path(digest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(tmp, dest)
+        return dest
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _install(cached: str, name: str, dest_dir: str):
+    """Hardlink (o copia) atomico dalla cache alla cartella delle effemeridi."""
+    os.makedirs(dest_dir, exist_ok=True)
+    dest = os.path.join(dest_dir, name)
+    tmp = dest + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(cached, tmp)
+    except OSError:
+        shutil.copyfile(cached, tmp)
+    os.replace(tmp, dest)
+
+
+def _already_installed(entry: dict, dest_dir: str) -> bool:
+    path = os.path.join(dest_dir, entry["name"])
+    if not os.path.isfile(path):
+        return False
+    if entry.get("size") is not None and os.path.getsize(path) != entry["size"]:
+        return False
+    return _sha256_file(path) == entry["sha256"]
+
+
+def _fetch_file(entry: dict, source: str) -> str:
+    cached = _cache_path(entry["sha256"])
+    if os.path.isfile(cached):
+        return cached
+    base = source if source.endswith("/") else source + "/"
+    url = urljoin(base, entry["name"]) if urlsplit(base).scheme else os.path.join(source, entry["name"])
+    _log(f"[INFO] Scarico {entry['name']}...")
+    stream = _open_source(url)
+    try:
+        return _store_stream(stream, entry["sha256"], entry["name"])
+    finally:
+        stream.close()
+
+
+def _fetch_from_archive(entries: list, archive: dict) -> dict:
+    """Estrae dallo zip (in cache) solo i membri richiesti, verificandoli in streaming."""
+    arch_sha = archive.get("sha256", "")
+    arch_path = _cache_path(arch_sha) if arch_sha else None
+    if not (arch_path and os.path.isfile(arch_path)):
+        _log(f"[INFO] Scarico archivio {archive['url']}...")
+        stream = _open_source(archive["url"])
+        try:
+            arch_path = _store_stream(stream, arch_sha, "archive")
+        finally:
+            stream.close()
+    if not zipfile.is_zipfile(arch_path):
+        raise ProvisionError("L'archivio scaricato non è uno ZIP valido (pagina HTML di errore?)")
+
+    out = {}
+    with zipfile.ZipFile(arch_path) as zf:
+        members = {os.path.basename(n): n for n in zf.namelist() if not n.endswith("/")}
+        for e in entries:
+            cached = _cache_path(e["sha256"])
+            if not os.path.isfile(cached):
+                if e["name"] not in members:
+                    raise ProvisionError(f"{e['name']} non presente nell'archivio")
+                with zf.open(members[e["name"]]) as member:
+                    cached = _store_stream(member, e["sha256"], e["name"])
+            out[e["name"]] = cached
+    return out
+
+
+def sync(manifest_path: str = EPHE_MANIFEST, years: str = EPHE_YEARS, dest_dir: str = EPHE_DIR,
+         source: str = EPHE_SOURCE, workers: int = EPHE_WORKERS) -> int:
+    with open(manifest_path, "r", encoding="utf-8") as fh:
+        manifest = json.load(fh)
+    entries = select_files(manifest["files"], parse_years(years))
+    todo = [e for e in entries if not _already_installed(e, dest_dir)]
+    _log(f"[INFO] {len(entries)} file per gli anni {years}, {len(todo)} da installare in '{dest_dir}'.")
+    if not todo:
+        return 0
+
+    archive = manifest.get("archive")
+    if archive and not source:
+        cached = _fetch_from_archive(todo, archive)
+    else:
+        src = source or manifest.get("source")
+        if not src:
+            raise ProvisionError("Manifest senza 'source' né 'archive' (o imposta EPHE_SOURCE).")
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            paths = list(pool.map(lambda e: _fetch_file(e, src), todo))
+        cached = {e["name"]: p for e, p in zip(todo, paths)}
+
+    for e in todo:
+        _install(cached[e["name"]], e["name"], dest_dir)
+    _log(f"[INFO] Installati {len(todo)} file (cache: {EPHE_CACHE_DIR}).")
+    return len(todo)
+
+
+def build_manifest(directory: str, source: str = "") -> dict:
+    """Manifest da una cartella di effemeridi verificata a mano."""
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            files.append({"name": name, "sha256": _sha256_file(path), "size": os.path.getsize(path)})
+    manifest = {"files": files}
+    if source:
+        manifest["source"] = source
+    return manifest
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Provisioning verificato delle effemeridi Swiss Ephemeris")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("sync", help="scarica/verifica/installa i file del manifest")
+    s.add_argument("--manifest", default=EPHE_MANIFEST)
+    s.add_argument("--years", default=EPHE_YEARS)
+    s.add_argument("--dest", default=EPHE_DIR)
+    s.add_argument("--source", default=EPHE_SOURCE, help="mirror alternativo (URL, file:// o cartella)")
+    s.add_argument("--workers", type=int, default=EPHE_WORKERS)
+    m = sub.add_parser("manifest", help="genera un manifest da una cartella esistente")
+    m.add_argument("directory")
+    m.add_argument("--source", default="")
+    a = ap.parse_args()
+
+    try:
+        if a.cmd == "sync":
+            sync(a.manifest, a.years, a.dest, a.source, a.workers)
+        else:
+            json.dump(build_manifest(a.directory, a.source), sys.stdout, indent=2)
+            sys.stdout.write("\n")
+    except (ProvisionError, OSError, requests.RequestException) as e:
+        _log(f"[ERROR] {e}")
+        sys.exit(1)
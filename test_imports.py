@@ -14,6 +14,10 @@ modules = [
     "urllib3",
     "gdown",
     "cachetools",
+    "numpy",
+    "starlette",
+    "httpx",
+    "uvicorn",
 ]
 
 errors = []
@@ -0,0 +1,197 @@
+# tz_grid.py
+"""
+Indice raster dei fusi orari davanti a TimezoneFinder.
+
+La griglia (risoluzione configurabile, in gradi) assegna a ogni cella l'indice
+del fuso solo se NESSUN lato dei poligoni di TimezoneFinder (contorni e buchi)
+tocca la cella, altrimenti 0 = cella di confine. Una cella senza lati di confine
+sta per intero dentro un solo poligono: la risposta in O(1) coincide con quella
+di TimezoneFinder per ogni punto della cella, anche per enclavi minuscole
+(San Marino, Vaticano, Baarle...), che cadono sempre in celle di confine.
+Le celle di confine passano a TimezoneFinder.
+
+L'array è salvato in .npy e aperto con mmap: i worker condividono le pagine
+tramite la page cache invece di caricare ognuno i propri dati.
+
+Generazione (una tantum, in build):
+    python tz_grid.py build [--res 0.5] [--workers 4]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+
+TZ_GRID_DIR = os.getenv("TZ_GRID_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tzgrid"))
+TZ_GRID_RES = float(os.getenv("TZ_GRID_RES", "0.5"))   # gradi per cella
+BORDER = 0
+GRID_METHOD = "polygon_edges"
+COORD_SCALE = 1e7   # TimezoneFinder salva le coordinate come int32 in 1e-7 gradi
+
+def _paths(res: float, base: str = TZ_GRID_DIR):
+    tag = f"{res:g}".replace(".", "p")
+    return os.path.join(base, f"tzgrid_{tag}.npy"), os.path.join(base, f"tzgrid_{tag}.json")
+
+class TzGrid:
+    """Griglia caricata: grid[row, col] = 0 (confine) oppure indice+1 in names."""
+
+    def __init__(self, grid, names, res):
+        self.grid = grid
+        self.names = names
+        self.res = float(res)
+        self.rows, self.cols = grid.shape
+        # names_arr[code] -> nome (None per i confini), per la versione vettoriale
+        self.names_arr = np.array([None] + list(names), dtype=object)
+
+    @classmethod
+    def load(cls, res: float = TZ_GRID_RES, base: str = TZ_GRID_DIR):
+        """Apre la griglia in mmap; None se i file non esistono (indice disabilitato)."""
+        npy, meta = _paths(res, base)
+        if not (os.path.exists(npy) and os.path.exists(meta)):
+            return None
+        with open(meta, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("method") != GRID_METHOD:
+            # griglie a campionamento (versioni precedenti): non affidabili sulle enclavi
+            print(f"[WARN] tz grid {npy} generata con un metodo obsoleto: rigenerala", file=sys.stderr)
+            return None
+        return cls(np.load(npy, mmap_mode="r"), info["names"], info["res"])
+
+    def _cells(self, lat, lon):
+        row = np.clip(((np.asarray(lat, dtype=np.float64) + 90.0) / self.res).astype(np.int64), 0, self.rows - 1)
+        col = np.clip(((np.asarray(lon, dtype=np.float64) + 180.0) / self.res).astype(np.int64), 0, self.cols - 1)
+        return row, col
+
+    def lookup(self, lat: float, lon: float):
+        """Nome del fuso per una cella interna, None se la cella è di confine."""
+        row = min(max(int((lat + 90.0) / self.res), 0), self.rows - 1)
+        col = min(max(int((lon + 180.0) / self.res), 0), self.cols - 1)
+        code = int(self.grid[row, col])
+        return self.names[code - 1] if code != BORDER else None
+
+    def lookup_many(self, lats, lons):
+        """Array di nomi (object) con None dove la cella è di confine."""
+        row, col = self._cells(lats, lons)
+        return self.names_arr[np.asarray(self.grid[row, col], dtype=np.int64)]
+
+# --- Costruzione ---
+_tf = None
+
+def _tf_init():
+    global _tf
+    from timezonefinder import TimezoneFinder
+    _tf = TimezoneFinder(in_memory=True)
+
+def _center_row(args):
+    """
+    Fuso del centro delle celle interne di una riga ("" per quelle di confine).
+    Solo fusi da poligono: in mare aperto TimezoneFinder ricava Etc/GMT±N dalla
+    longitudine, con confini che non sono lati di poligoni -> cella di confine.
+    """
+    lat, lons, interior = args
+    return [_tf.timezone_at_land(lng=float(lo), lat=float(lat)) or "" if ok else ""
+            for lo, ok in zip(lons, interior)]
+
+def _rings(tf):
+    """Contorni e buchi di tutti i poligoni dei fusi, in gradi (array 2 x n)."""
+    for nr in range(tf.nr_of_polygons):
+        yield tf.coords_of(nr) / COORD_SCALE
+        for hole in tf._holes_of_poly(nr):
+            yield np.asarray(hole) / COORD_SCALE
+
+def _mark_ring(border, ring, res):
+    """
+    Segna come confine ogni cella toccata dai lati di un anello. I lati sono
+    suddivisi a passo <= res/2 e per ogni tratto si segna il suo rettangolo
+    d'ingombro (allargato di un epsilon sui bordi delle celle): stima per eccesso,
+    nessuna cella attraversata da un lato resta interna.
+    """
+    rows, cols = border.shape
+    x = np.append(ring[0], ring[0][:1])
+    y = np.append(ring[1], ring[1][:1])
+    dx, dy = np.diff(x), np.diff(y)
+    k = np.maximum(1, np.ceil(np.maximum(np.abs(dx), np.abs(dy)) / (res / 2.0))).astype(np.int64)
+    seg = np.repeat(np.arange(len(k)), k)
+    frac = (np.arange(k.sum()) - np.repeat(np.cumsum(k) - k, k)) / np.repeat(k, k)
+    px = np.append(x[:-1][seg] + frac * dx[seg], x[-1])
+    py = np.append(y[:-1][seg] + frac * dy[seg], y[-1])
+
+    eps = 1e-9
+    x0, x1 = np.minimum(px[:-1], px[1:]) - eps, np.maximum(px[:-1], px[1:]) + eps
+    y0, y1 = np.minimum(py[:-1], py[1:]) - eps, np.maximum(py[:-1], py[1:]) + eps
+    c0 = np.clip(np.floor((x0 + 180.0) / res).astype(np.int64), 0, cols - 1)
+    c1 = np.clip(np.floor((x1 + 180.0) / res).astype(np.int64), 0, cols - 1)
+    r0 = np.clip(np.floor((y0 + 90.0) / res).astype(np.int64), 0, rows - 1)
+    r1 = np.clip(np.floor((y1 + 90.0) / res).astype(np.int64), 0, rows - 1)
+    # tratti lunghi al più res/2 (+eps): al massimo 3 celle per asse
+    for dr in range(3):
+        for dc in range(3):
+            m = (r0 + dr <= r1) & (c0 + dc <= c1)
+            border[r0[m] + dr, c0[m] + dc] = True
+
+def build(res: float = TZ_GRID_RES, workers: int = 1, base: str = TZ_GRID_DIR):
+    """
+    Celle di confine = celle toccate dai lati dei poligoni; per le altre basta il
+    fuso del centro, che vale per tutta la cella.
+    """
+    rows, cols = int(round(180.0 / res)), int(round(360.0 / res))
+    t0 = time.time()
+    _tf_init()
+    border = np.zeros((rows, cols), dtype=bool)
+    for ring in _rings(_tf):
+        _mark_ring(border, ring, res)
+
+    lat_c = -90.0 + (np.arange(rows) + 0.5) * res
+    lon_c = -180.0 + (np.arange(cols) + 0.5) * res
+    jobs = [(lat_c[r], lon_c, ~border[r]) for r in range(rows)]
+    if workers > 1:
+        from multiprocessing import Pool
+        with Pool(workers, initializer=_tf_init) as pool:
+            center_names = pool.map(_center_row, jobs, chunksize=8)
+    else:
+        center_names = [_center_row(j) for j in jobs]
+
+    names = sorted({n for row in center_names for n in row if n})
+    index = {n: i + 1 for i, n in enumerate(names)}
+    grid = np.array([[index.get(n, BORDER) for n in row] for row in center_names], dtype=np.uint16)
+
+    os.makedirs(base, exist_ok=True)
+    npy, meta = _paths(res, base)
+    np.save(npy, grid)
+    with open(meta, "w", encoding="utf-8") as f:
+        json.dump({"res": res, "method": GRID_METHOD, "names": names}, f)
+    interior = float(np.count_nonzero(grid)) / grid.size
+    print(f"[INFO] tz grid {rows}x{cols} res={res} interior={interior:.1%} "
+          f"in {time.time() - t0:.0f}s -> {npy}", flush=True)
+    return npy
+
+# --- Istanza condivisa (lazy) ---
+_GRID = None
+_GRID_LOADED = False
+_GRID_LOCK = threading.Lock()
+
+def get_grid():
+    """Griglia di processo, caricata al primo uso; None se non è stata generata."""
+    global _GRID, _GRID_LOADED
+    if not _GRID_LOADED:
+        with _GRID_LOCK:
+            if not _GRID_LOADED:
+                try:
+                    _GRID = TzGrid.load()
+                except Exception as e:
+                    print(f"[WARN] tz grid non caricabile: {e}", file=sys.stderr)
+                    _GRID = None
+                _GRID_LOADED = True
+    return _GRID
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Genera la griglia dei fusi orari")
+    ap.add_argument("cmd", choices=["build"])
+    ap.add_argument("--res", type=float, default=TZ_GRID_RES)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--out", default=TZ_GRID_DIR)
+    a = ap.parse_args()
+    build(a.res, a.workers, a.out)
@@ -0,0 +1,157 @@
+# tz_offsets.py
+"""
+Conversione ora locale -> UTC con tabelle di transizione precalcolate.
+
+Per ogni fuso (costruita al primo uso e poi in cache) teniamo l'array ordinato
+degli istanti UTC di transizione e l'offset valido da ciascuno in poi, letti dai
+dati tzfile di pytz. La conversione è una ricerca binaria invece di
+tz.localize() con gestione via eccezioni; orari ambigui e inesistenti seguono
+una policy esplicita. local_to_utc_many() converte molti orari insieme (NumPy).
+"""
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import numpy as np
+import pytz
+from pytz import AmbiguousTimeError, NonExistentTimeError
+
+EPOCH = datetime(1970, 1, 1)
+
+# Policy per orari ambigui (ritorno dell'ora legale: l'orario capita due volte)
+#   earlier: prima occorrenza (di norma l'ora legale, come localize(is_dst=True))
+#   later:   seconda occorrenza
+#   raise:   AmbiguousTimeError
+AMBIGUOUS_POLICIES = ("earlier", "later", "raise")
+# Policy per orari inesistenti (salto in avanti: es. 02:30 il giorno del cambio)
+#   shift_forward:  interpreta con l'offset precedente -> cade dopo il salto (02:30 -> 03:30)
+#   shift_backward: interpreta con l'offset successivo -> cade prima del salto (02:30 -> 01:30)
+#   raise:          NonExistentTimeError
+NONEXISTENT_POLICIES = ("shift_forward", "shift_backward", "raise")
+
+_INF = float("inf")
+
+class ZoneTable:
+    """Transizioni di un fuso: trans[i] (secondi epoch UTC) da cui vale offs[i] (secondi)."""
+    __slots__ = ("name", "trans", "offs", "np_trans", "np_offs")
+
+    def __init__(self, name, trans, offs):
+        self.name = name
+        self.trans = trans
+        self.offs = offs
+        # np_trans[i] = inizio dell'intervallo i, np_trans[i + 1] = sua fine
+        self.np_trans = np.array(trans + [_INF], dtype=np.float64)
+        self.np_offs = np.array(offs, dtype=np.float64)
+
+    def end(self, i):
+        return self.trans[i + 1] if i + 1 < len(self.trans) else _INF
+
+_BUILD_LOCK = threading.Lock()
+
+@lru_cache(maxsize=1024)
+def zone_table(tzname: str) -> ZoneTable:
+    """Tabella del fuso (lazy, una volta per processo)."""
+    with _BUILD_LOCK:
+        tz = pytz.timezone(tzname)
+        utc_times = getattr(tz, "_utc_transition_times", None)
+        if not utc_times:
+            # StaticTzInfo / UTC: offset unico
+            off = tz.utcoffset(datetime(2000, 1, 1)).total_seconds()
+            return ZoneTable(tzname, [-_INF], [off])
+        trans = [-_INF] + [(t - EPOCH).total_seconds() for t in utc_times[1:]]
+        offs = [info[0].total_seconds() for info in tz._transition_info]
+        return ZoneTable(tzname, trans, offs)
+
+def _check_policies(ambiguous, nonexistent):
+    if ambiguous not in AMBIGUOUS_POLICIES:
+        raise ValueError(f"unknown ambiguous policy: {ambiguous!r}")
+    if nonexistent not in NONEXISTENT_POLICIES:
+        raise ValueError(f"unknown nonexistent policy: {nonexistent!r}")
+
+def _resolve(tbl: ZoneTable, t: float, naive, ambiguous, nonexistent):
+    """Offset (secondi) dell'orario locale t (secondi epoch 'come se fosse UTC')."""
+    k = bisect_right(tbl.trans, t) - 1
+    lo, hi = max(0, k - 1), min(len(tbl.offs) - 1, k + 1)
+    valid = [i for i in range(lo, hi + 1) if tbl.trans[i] <= t - tbl.offs[i] < tbl.end(i)]
+    if len(valid) == 1:
+        return tbl.offs[valid[0]], tbl.offs[valid[0]]
+    if valid:
+        if ambiguous == "raise":
+            raise AmbiguousTimeError(naive)
+        i = valid[0] if ambiguous == "earlier" else valid[-1]
+        return tbl.offs[i], tbl.offs[i]
+    if nonexistent == "raise":
+        raise NonExistentTimeError(naive)
+    # salto: la transizione j con t prima del salto secondo offs[j-1] e dopo secondo offs[j]
+    for j in range(max(1, lo), hi + 1):
+        if t - tbl.offs[j - 1] >= tbl.trans[j] > t - tbl.offs[j]:
+            before, after = tbl.offs[j - 1], tbl.offs[j]
+            # (offset per calcolare l'UTC, offset da mostrare sull'ora locale risultante)
+            return (before, after) if nonexistent == "shift_forward" else (after, before)
+    return tbl.offs[k], tbl.offs[k]
+
+def local_to_utc(tzname: str, naive: datetime, ambiguous="earlier", nonexistent="shift_forward"):
+    """
+    Converte un datetime naive locale. Ritorna (local_dt, utc_dt) entrambi aware:
+    local_dt con offset fisso (per orari inesistenti è l'orario spostato dalla policy).
+    """
+    _check_policies(ambiguous, nonexistent)
+    tbl = zone_table(tzname)
+    t = (naive - EPOCH).total_seconds()
+    utc_off, local_off = _resolve(tbl, t, naive, ambiguous, nonexistent)
+    utc_naive = naive - timedelta(seconds=utc_off)
+    utc_dt = utc_naive.replace(tzinfo=timezone.utc)
+    local_dt = (utc_naive + timedelta(seconds=local_off)).replace(
+        tzinfo=timezone(timedelta(seconds=local_off))
+    )
+    return local_dt, utc_dt
+
+def local_to_utc_many(tzname: str, local_seconds, ambiguous="earlier", nonexistent="shift_forward"):
+    """
+    Versione vettoriale: local_seconds = array di orari locali in secondi epoch
+    ('come se fossero UTC'), oppure lista di datetime naive.
+    Ritorna (utc_seconds, offsets) come array float64.
+    """
+    _check_policies(ambiguous, nonexistent)
+    tbl = zone_table(tzname)
+    t = np.asarray(
+        [(d - EPOCH).total_seconds() for d in local_seconds]
+        if len(local_seconds) and isinstance(local_seconds[0], datetime) else local_seconds,
+        dtype=np.float64,
+    )
+    n = len(tbl.offs)
+    starts, offs = tbl.np_trans, tbl.np_offs
+    k = np.searchsorted(starts, t, side="right") - 1
+    cands = [np.clip(k + d, 0, n - 1) for d in (-1, 0, 1)]
+    ok = [(starts[c] <= t - offs[c]) & (t - offs[c] < starts[c + 1]) for c in cands]
+
+    chosen = np.full(t.shape, -1, dtype=np.int64)
+    order = (0, 1, 2) if ambiguous != "later" else (2, 1, 0)
+    for idx in order:
+        chosen = np.where((chosen < 0) & ok[idx], cands[idx], chosen)
+    nvalid = ok[0].astype(int) + (ok[1] & (cands[1] != cands[0])) + (ok[2] & (cands[2] != cands[1]))
+    if ambiguous == "raise" and np.any(nvalid > 1):
+        raise AmbiguousTimeError(f"{int(np.sum(nvalid > 1))} ambiguous local times in {tzname}")
+
+    gap = chosen < 0
+    if np.any(gap):
+        if nonexistent == "raise":
+            raise NonExistentTimeError(f"{int(np.sum(gap))} nonexistent local times in {tzname}")
+        j = np.zeros(t.shape, dtype=np.int64)
+        for c in cands:
+            c1 = np.maximum(c, 1)
+            hit = gap & (j == 0) & (t - offs[c1 - 1] >= starts[c1]) & (starts[c1] > t - offs[c1])
+            j = np.where(hit, c1, j)
+        pick = j - 1 if nonexistent == "shift_forward" else j
+        chosen = np.where(gap, np.where(j > 0, pick, k), chosen)
+
+    utc_off = offs[chosen]
+    return t - utc_off, utc_off
+
+def utc_offsets_many(tzname: str, utc_seconds):
+    """Offset (secondi) in vigore negli istanti UTC dati (secondi epoch): nessuna ambiguità."""
+    tbl = zone_table(tzname)
+    t = np.asarray(utc_seconds, dtype=np.float64)
+    k = np.searchsorted(tbl.np_trans, t, side="right") - 1
+    return tbl.np_offs[np.clip(k, 0, len(tbl.offs) - 1)]